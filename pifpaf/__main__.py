@@ -13,27 +13,29 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-import importlib.metadata
+import hashlib
+import importlib
+import json
 import logging
 import os
 import signal
 import sys
+import tempfile
 import traceback
 
 import click
 
-import daiquiri
+from pifpaf import tracing
 
-import fixtures
-
-import psutil
-
-from pifpaf import util
-
-LOG = daiquiri.getLogger("pifpaf")
+# Heavy modules (daiquiri, fixtures, psutil, the drivers) are only imported
+# once they are needed, as pifpaf is often run just to list the daemons or
+# print its help
+LOG = logging.getLogger("pifpaf")
 
 
 def _format_multiple_exceptions(e, debug=False):
+    import fixtures
+
     valid_excs = []
     # NOTE(sileht): Why do I not use this ? :
     #   excs = list(e.args)
@@ -67,20 +69,105 @@ def _format_multiple_exceptions(e, debug=False):
                 LOG.error(value)
 
 
-if sys.version_info >= (3, 10):
-    DAEMONS = importlib.metadata.entry_points(group='pifpaf.daemons')
-else:
-    DAEMONS = importlib.metadata.entry_points()['pifpaf.daemons']
+_DAEMONS = None
 
 
-def _daemons_names():
-    names = []
-    if hasattr(DAEMONS, 'names'):
-        names = DAEMONS.names
+def _get_daemons_index_path():
+    cache_home = os.getenv("XDG_CACHE_HOME",
+                           os.path.join(os.path.expanduser("~"), ".cache"))
+    return os.path.join(cache_home, "pifpaf", "daemons.json")
+
+
+def _get_daemons_index_key():
+    # Installing or removing a package changes the modification time of its
+    # directory in sys.path
+    paths = []
+    for path in sys.path:
+        try:
+            paths.append((path, os.stat(path or ".").st_mtime_ns))
+        except OSError:
+            paths.append((path, None))
+    return hashlib.sha1(json.dumps(
+        [sys.executable, sys.version, paths]).encode()).hexdigest()
+
+
+def _load_daemons(use_cache=True):
+    """Return the (name, entry point) list of the `pifpaf.daemons` group.
+
+    Reading the entry points of all the installed packages is slow, so the
+    list is cached until the Python environment changes.
+    """
+    path = _get_daemons_index_path()
+    key = _get_daemons_index_key()
+    if use_cache:
+        try:
+            with open(path) as f:
+                index = json.load(f)
+            if index["key"] == key:
+                return [tuple(daemon) for daemon in index["daemons"]]
+        except (OSError, ValueError, KeyError):
+            pass
+
+    import importlib.metadata
+
+    if sys.version_info >= (3, 10):
+        entry_points = importlib.metadata.entry_points(group='pifpaf.daemons')
     else:
-        for i in DAEMONS:
-            names.append(i.name)
-    return names
+        entry_points = importlib.metadata.entry_points()['pifpaf.daemons']
+    daemons = [(e.name, e.value) for e in entry_points]
+
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with tempfile.NamedTemporaryFile("w", dir=os.path.dirname(path),
+                                         delete=False) as f:
+            json.dump({"key": key, "daemons": daemons}, f)
+        os.replace(f.name, path)
+    except OSError as e:
+        LOG.debug("Unable to write %s: %s", path, e)
+    return daemons
+
+
+def _get_daemons():
+    global _DAEMONS
+    if _DAEMONS is None:
+        _DAEMONS = _load_daemons()
+    return _DAEMONS
+
+
+def _daemons_names():
+    return [name for name, value in _get_daemons()]
+
+
+def _load_entry_point(value):
+    module, _, attrs = value.partition(":")
+    obj = importlib.import_module(module.strip())
+    for attr in filter(None, attrs.strip().split(".")):
+        obj = getattr(obj, attr)
+    return obj
+
+
+def _get_daemon(name):
+    global _DAEMONS
+    value = dict(_get_daemons()).get(name)
+    try:
+        if value is not None:
+            return _load_entry_point(value)
+    except (ImportError, AttributeError):
+        # The cached index may be outdated
+        LOG.debug("Unable to load %s, reloading the daemons", value,
+                  exc_info=True)
+    _DAEMONS = _load_daemons(use_cache=False)
+    value = dict(_DAEMONS).get(name)
+    if value is None:
+        raise RuntimeError("Unknown daemon `%s'" % name)
+    return _load_entry_point(value)
+
+
+def _check_daemon(name, param_hint):
+    try:
+        _get_daemon(name)
+    except RuntimeError as e:
+        raise click.BadParameter(str(e), param_hint=param_hint)
 
 
 @click.group()
@@ -93,10 +180,62 @@ def _daemons_names():
 @click.option("--global-urls-variable", "-g",
               help="global variable name to use to append connection URL  "
               "when chaining multiple pifpaf instances (default: PIFPAF_URLS)")
-@click.version_option(importlib.metadata.distribution('pifpaf').version)
+@click.option("--cache-dir", envvar="PIFPAF_CACHE_DIR",
+              help="Directory where to cache bootstrapped data directories "
+              "to speed up next runs (default: no cache)",
+              type=click.Path(file_okay=False))
+@click.option("--cgroup/--no-cgroup", envvar="PIFPAF_CGROUP", default=None,
+              help="Run each daemon in its own cgroup v2 to kill all its "
+              "processes reliably and report the resources they used. The "
+              "cgroup pifpaf runs in must be writable (e.g. delegated with "
+              "`systemd-run --user --scope -p Delegate=yes`).")
+@click.option("--cgroup-limit", "cgroup_limits", multiple=True,
+              metavar="KEY=VALUE",
+              help="Set a cgroup v2 interface file of each daemon cgroup, "
+              "e.g. memory.max=1G (implies --cgroup)")
+@click.option("--storage", type=click.Choice(["disk", "memory"]),
+              envvar="PIFPAF_STORAGE",
+              help="Where to store the data of the daemons: `memory` uses "
+              "/dev/shm when it has enough free space (default: disk)")
+@click.option("--dynamic-ports", is_flag=True, default=None,
+              envvar="PIFPAF_DYNAMIC_PORTS",
+              help="Use free ports rather than the default ports of the "
+              "daemons, so several pifpaf can run at the same time")
+@click.version_option(package_name="pifpaf")
 @click.pass_context
 def main(ctx, verbose=False, debug=False, log_file=None,
-         env_prefix=None, global_urls_variable=None):
+         env_prefix=None, global_urls_variable=None, cache_dir=None,
+         cgroup=None, cgroup_limits=(), dynamic_ports=None, storage=None):
+    ctx.obj = {
+        "debug": debug,
+        "verbose": verbose,
+        "log_file": log_file,
+    }
+    if env_prefix is not None:
+        ctx.obj['env_prefix'] = env_prefix
+    if global_urls_variable is not None:
+        ctx.obj['global_urls_variable'] = global_urls_variable
+    if cache_dir is not None:
+        # Exported so sub-drivers and nested pifpaf use it too
+        os.environ["PIFPAF_CACHE_DIR"] = os.path.abspath(cache_dir)
+    if storage is not None:
+        os.environ["PIFPAF_STORAGE"] = storage
+    if dynamic_ports:
+        os.environ["PIFPAF_DYNAMIC_PORTS"] = "1"
+    if cgroup_limits:
+        os.environ["PIFPAF_CGROUP_LIMITS"] = ",".join(cgroup_limits)
+        cgroup = True
+    if cgroup is not None:
+        if cgroup:
+            os.environ["PIFPAF_CGROUP"] = "1"
+        else:
+            os.environ.pop("PIFPAF_CGROUP", None)
+
+
+def _setup_logging(ctx):
+    # Only done by the commands running daemons, daiquiri is slow to import
+    import daiquiri
+
     formatter = daiquiri.formatter.ColorFormatter(
         fmt="%(color)s%(levelname)s "
         "[%(name)s] %(message)s%(color_stop)s")
@@ -105,21 +244,13 @@ def main(ctx, verbose=False, debug=False, log_file=None,
         daiquiri.output.Stream(sys.stderr, formatter=formatter)
     ]
 
-    if log_file:
-        outputs.append(daiquiri.output.File(log_file,
+    if ctx.obj['log_file']:
+        outputs.append(daiquiri.output.File(ctx.obj['log_file'],
                                             formatter=formatter))
 
-    ctx.obj = {
-        "debug": debug,
-    }
-    if env_prefix is not None:
-        ctx.obj['env_prefix'] = env_prefix
-    if global_urls_variable is not None:
-        ctx.obj['global_urls_variable'] = global_urls_variable
-
-    if debug:
+    if ctx.obj['debug']:
         level = logging.DEBUG
-    elif verbose:
+    elif ctx.obj['verbose']:
         level = logging.INFO
     else:
         level = logging.WARNING
@@ -140,8 +271,19 @@ class RunGroup(click.MultiCommand):
 
     def get_command(self, ctx, name):
         params = [click.Argument(["command"], nargs=-1)]
-        plugin = [e for e in DAEMONS if e.name == name][0].load()
-        params.extend(map(lambda kw: click.Option(**kw), plugin.get_options()))
+        try:
+            plugin = _get_daemon(name)
+        except RuntimeError:
+            # click reports the unknown command
+            return None
+        port_options = plugin.get_port_option_names()
+        for kw in plugin.get_options():
+            if (os.getenv("PIFPAF_DYNAMIC_PORTS") and
+               kw["param_decls"][0].lstrip("-").replace("-", "_")
+               in port_options):
+                # 0 makes the driver allocate a free port
+                kw = dict(kw, default=0)
+            params.append(click.Option(**kw))
 
         def _run_cb(*args, **kwargs):
             return self._run(name, plugin, ctx, *args, **kwargs)
@@ -159,18 +301,17 @@ class RunGroup(click.MultiCommand):
             with formatter.section('Commands'):
                 formatter.write_dl(rows)
 
+    @staticmethod
+    def _make_driver(daemon, plugin, ctx, kwargs):
+        return plugin(env_prefix=ctx.obj['env_prefix'],
+                      debug=ctx.obj['debug'],
+                      **kwargs)
+
     def _run(self, daemon, plugin, ctx, command, **kwargs):
         debug = ctx.obj['debug']
         env_prefix = ctx.obj['env_prefix']
         global_urls_variable = ctx.obj['global_urls_variable']
-        driver = plugin(env_prefix=env_prefix,
-                        debug=debug,
-                        **kwargs)
-
-        daemon = daemon
-
-        def putenv(key, value):
-            return os.putenv(env_prefix + "_" + key, value)
+        driver = self._make_driver(daemon, plugin, ctx, kwargs)
 
         def expand_urls_var(url):
             current_urls = os.getenv(global_urls_variable)
@@ -178,118 +319,151 @@ class RunGroup(click.MultiCommand):
                 return current_urls + ";" + url
             return url
 
+        _setup_driver(driver, daemon, debug)
+
         if command:
-            try:
-                driver.setUp()
-            except fixtures.MultipleExceptions as e:
-                _format_multiple_exceptions(e, debug)
-                sys.exit(1)
-            except Exception:  # noqa: B902
-                LOG.error("Unable to start %s, "
-                          "use --debug for more information",
-                          daemon, exc_info=True)
-                sys.exit(1)
-
-            putenv("PID", str(os.getpid()))
-            putenv("DAEMON", daemon)
             url = os.getenv(driver.env_prefix + "_URL")
-            putenv("%s_URL" % daemon.upper(), url)
-            os.putenv(global_urls_variable,
-                      expand_urls_var(url))
-
-            try:
-                c = psutil.Popen(command, preexec_fn=os.setsid)
-            except Exception:  # noqa: B902
-                driver.cleanUp()
-                raise RuntimeError("Unable to start command: %s"
-                                   % " ".join(command))
-            LOG.info(
-                "Command `%s` (pid %s) is ready",
-                " ".join(command), c.pid
-            )
-
-            def _cleanup(signum=None, frame=None, ret=0):
-                signal.signal(signal.SIGTERM, signal.SIG_IGN)
-                signal.signal(signal.SIGHUP, signal.SIG_IGN)
-                signal.signal(signal.SIGINT, signal.SIG_IGN)
-                try:
-                    driver.cleanUp()
-                except Exception:  # noqa: B902
-                    LOG.error("Unexpected cleanUp error", exc_info=True)
-                util.process_cleaner(c)
-                sys.exit(1 if signum == signal.SIGINT else ret)
-
-            signal.signal(signal.SIGTERM, _cleanup)
-            signal.signal(signal.SIGHUP, _cleanup)
-            signal.signal(signal.SIGINT, _cleanup)
-            signal.signal(signal.SIGPIPE, signal.SIG_IGN)
-
-            try:
-                ret = c.wait()
-            except KeyboardInterrupt:
-                ret = 1
-            _cleanup(ret=ret)
+            _run_command(driver, command, {
+                env_prefix + "_PID": str(os.getpid()),
+                env_prefix + "_DAEMON": daemon,
+                env_prefix + "_%s_URL" % daemon.upper(): url,
+                global_urls_variable: expand_urls_var(url),
+            })
         else:
-            try:
-                driver.setUp()
-            except fixtures.MultipleExceptions as e:
-                _format_multiple_exceptions(e, debug)
-                sys.exit(1)
-            except Exception:  # noqa: B902
-                LOG.error("Unable to start %s, "
-                          "use --debug for more information",
-                          daemon, exc_info=True)
-                sys.exit(1)
-            pid = os.fork()
-            if pid == 0:
-                os.setsid()
-                devnull = os.open(os.devnull, os.O_RDWR)
-                os.dup2(devnull, 0)
-                os.dup2(devnull, 1)
-                os.dup2(devnull, 2)
-
-                def _cleanup(signum, frame):
-                    driver.cleanUp()
-                    sys.exit(0)
-
-                signal.signal(signal.SIGTERM, _cleanup)
-                signal.signal(signal.SIGHUP, _cleanup)
-                signal.signal(signal.SIGINT, _cleanup)
-                signal.signal(signal.SIGPIPE, signal.SIG_IGN)
-                signal.pause()
-            else:
-                url = driver.env['%s_URL' % driver.env_prefix]
-                driver.env.update({
-                    "PIFPAF_PID": pid,
-                    env_prefix + "_PID": pid,
-                    env_prefix + "_DAEMON": daemon,
-                    (env_prefix + "_" +
-                     daemon.upper() + "_URL"): url,
-                    global_urls_variable:
-                    expand_urls_var(url),
-                    "%s_OLD_PS1" % env_prefix:
-                    os.getenv("PS1", ""),
-                    "PS1":
-                    "(pifpaf/" + daemon + ") " + os.getenv("PS1", ""),
-                })
-                for k, v in driver.env.items():
-                    print("export %s=\"%s\";" % (k, v))
-                print("%(prefix_lower)s_stop () { "
-                      "if test -z \"$%(prefix)s_PID\"; then "
-                      "echo 'No PID found in $%(prefix)s_PID'; return -1; "
-                      "fi; "
-                      "if kill $%(prefix)s_PID; then "
-                      "_PS1=$%(prefix)s_OLD_PS1; "
-                      "unset %(vars)s; "
-                      "PS1=$_PS1; unset _PS1; "
-                      "unset -f %(prefix_lower)s_stop; "
-                      "unalias pifpaf_stop 2>/dev/null || true; "
-                      "fi; } ; "
-                      "alias pifpaf_stop=%(prefix_lower)s_stop ; "
-                      % {"prefix": env_prefix,
-                         "prefix_lower":
-                         env_prefix.lower(),
-                         "vars": " ".join(driver.env)})
+            pid = _daemonize(driver)
+            url = driver.env['%s_URL' % driver.env_prefix]
+            driver.env.update({
+                "PIFPAF_PID": pid,
+                env_prefix + "_PID": pid,
+                env_prefix + "_DAEMON": daemon,
+                (env_prefix + "_" +
+                 daemon.upper() + "_URL"): url,
+                global_urls_variable:
+                expand_urls_var(url),
+            })
+            _print_exports(driver.env, env_prefix, daemon)
+
+
+class LeaseGroup(RunGroup):
+    @staticmethod
+    def _make_driver(daemon, plugin, ctx, kwargs):
+        from pifpaf import agent
+
+        # Only send the options given on the command line, so that leases
+        # using the defaults share the same pool and get a free port
+        sub_ctx = click.get_current_context()
+        options = dict(
+            (key, value) for key, value in kwargs.items()
+            if (sub_ctx.get_parameter_source(key) !=
+                click.core.ParameterSource.DEFAULT))
+        return agent.Lease(daemon, options,
+                           env_prefix=ctx.obj['env_prefix'],
+                           path=ctx.obj['socket'])
+
+
+def _setup_driver(driver, name, debug):
+    import fixtures
+
+    try:
+        driver.setUp()
+    except fixtures.MultipleExceptions as e:
+        _format_multiple_exceptions(e, debug)
+        sys.exit(1)
+    except Exception:  # noqa: B902
+        LOG.error("Unable to start %s, "
+                  "use --debug for more information",
+                  name, exc_info=True)
+        sys.exit(1)
+
+
+def _run_command(driver, command, env):
+    import psutil
+
+    from pifpaf import util
+
+    for key, value in env.items():
+        os.putenv(key, value)
+
+    try:
+        c = psutil.Popen(command, preexec_fn=os.setsid)
+    except Exception:  # noqa: B902
+        driver.cleanUp()
+        raise RuntimeError("Unable to start command: %s"
+                           % " ".join(command))
+    LOG.info(
+        "Command `%s` (pid %s) is ready",
+        " ".join(command), c.pid
+    )
+
+    def _cleanup(signum=None, frame=None, ret=0):
+        signal.signal(signal.SIGTERM, signal.SIG_IGN)
+        signal.signal(signal.SIGHUP, signal.SIG_IGN)
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        try:
+            driver.cleanUp()
+        except Exception:  # noqa: B902
+            LOG.error("Unexpected cleanUp error", exc_info=True)
+        util.process_cleaner(c)
+        sys.exit(1 if signum == signal.SIGINT else ret)
+
+    signal.signal(signal.SIGTERM, _cleanup)
+    signal.signal(signal.SIGHUP, _cleanup)
+    signal.signal(signal.SIGINT, _cleanup)
+    signal.signal(signal.SIGPIPE, signal.SIG_IGN)
+
+    try:
+        ret = c.wait()
+    except KeyboardInterrupt:
+        ret = 1
+    _cleanup(ret=ret)
+
+
+def _daemonize(driver):
+    pid = os.fork()
+    if pid == 0:
+        os.setsid()
+        devnull = os.open(os.devnull, os.O_RDWR)
+        os.dup2(devnull, 0)
+        os.dup2(devnull, 1)
+        os.dup2(devnull, 2)
+
+        def _cleanup(signum, frame):
+            driver.cleanUp()
+            sys.exit(0)
+
+        signal.signal(signal.SIGTERM, _cleanup)
+        signal.signal(signal.SIGHUP, _cleanup)
+        signal.signal(signal.SIGINT, _cleanup)
+        signal.signal(signal.SIGPIPE, signal.SIG_IGN)
+        signal.pause()
+    return pid
+
+
+def _print_exports(env, env_prefix, name):
+    env.update({
+        "%s_OLD_PS1" % env_prefix:
+        os.getenv("PS1", ""),
+        "PS1":
+        "(pifpaf/" + name + ") " + os.getenv("PS1", ""),
+    })
+    for k, v in env.items():
+        print("export %s=\"%s\";" % (k, v))
+    print("%(prefix_lower)s_stop () { "
+          "if test -z \"$%(prefix)s_PID\"; then "
+          "echo 'No PID found in $%(prefix)s_PID'; return -1; "
+          "fi; "
+          "if kill $%(prefix)s_PID; then "
+          "_PS1=$%(prefix)s_OLD_PS1; "
+          "unset %(vars)s; "
+          "PS1=$_PS1; unset _PS1; "
+          "unset -f %(prefix_lower)s_stop; "
+          "unalias pifpaf_stop 2>/dev/null || true; "
+          "fi; } ; "
+          "alias pifpaf_stop=%(prefix_lower)s_stop ; "
+          % {"prefix": env_prefix,
+             "prefix_lower":
+             env_prefix.lower(),
+             "vars": " ".join(env)})
 
 
 @main.command(name="run", help="Run a daemon", cls=RunGroup)
@@ -298,15 +472,183 @@ class RunGroup(click.MultiCommand):
 @click.option("--global-urls-variable", "-g", default="PIFPAF_URLS",
               help="global variable name to use to append connection URL  "
               "when chaining multiple pifpaf instances (default: PIFPAF_URLS)")
+@click.option("--trace", "trace_file", type=click.Path(dir_okay=False),
+              help="Write how long each step of the daemon start and stop "
+              "took to this file")
+@click.option("--trace-format", type=click.Choice(tracing.FORMATS),
+              default="json",
+              help="Format of the trace file: `chrome` can be loaded in "
+              "chrome://tracing or Perfetto (default: json)")
+@click.pass_context
+def run(ctx, env_prefix, global_urls_variable, trace_file, trace_format):
+    _setup_logging(ctx)
+    ctx.obj['env_prefix'] = ctx.obj.get('env_prefix', env_prefix)
+    ctx.obj['global_urls_variable'] = ctx.obj.get('global_urls_variable',
+                                                  global_urls_variable)
+    if trace_file:
+        tracing.dump_at_exit(trace_file, trace_format)
+
+
+@main.command(name="up",
+              help="Run all the daemons described in a TOML or YAML file")
+@click.option("--env-prefix", "-e", default="PIFPAF",
+              help="Prefix to use for environment variables (default: PIFPAF)")
+@click.option("--global-urls-variable", "-g", default="PIFPAF_URLS",
+              help="global variable name to use to append connection URL  "
+              "when chaining multiple pifpaf instances (default: PIFPAF_URLS)")
+@click.option("--jobs", "-j", type=int,
+              help="Maximum number of daemons to start at the same time")
+@click.argument("topology_file", type=click.Path(exists=True,
+                                                 dir_okay=False))
+@click.argument("command", nargs=-1)
 @click.pass_context
-def run(ctx, env_prefix, global_urls_variable):
+def up(ctx, env_prefix, global_urls_variable, jobs, topology_file, command):
+    from pifpaf import topology
+
+    _setup_logging(ctx)
+    debug = ctx.obj['debug']
+    env_prefix = ctx.obj.get('env_prefix', env_prefix)
+    global_urls_variable = ctx.obj.get('global_urls_variable',
+                                       global_urls_variable)
+
+    try:
+        nodes = topology.load(topology_file)
+    except Exception as e:  # noqa: B902
+        LOG.error("Unable to load %s: %s", topology_file, e)
+        sys.exit(1)
+
+    t = topology.Topology(nodes, _get_daemon,
+                          env_prefix=env_prefix,
+                          global_urls_variable=global_urls_variable,
+                          jobs=jobs, debug=debug,
+                          dynamic_ports=bool(
+                              os.getenv("PIFPAF_DYNAMIC_PORTS")))
+    _setup_driver(t, topology_file, debug)
+
+    if command:
+        env = dict(t.env)
+        env[env_prefix + "_PID"] = str(os.getpid())
+        _run_command(t, command, env)
+    else:
+        pid = _daemonize(t)
+        t.env.update({
+            "PIFPAF_PID": pid,
+            env_prefix + "_PID": pid,
+        })
+        _print_exports(t.env, env_prefix, "up")
+
+
+@main.command(name="lease", help="Lease a running daemon from an agent",
+              cls=LeaseGroup)
+@click.option("--env-prefix", "-e", default="PIFPAF",
+              help="Prefix to use for environment variables (default: PIFPAF)")
+@click.option("--global-urls-variable", "-g", default="PIFPAF_URLS",
+              help="global variable name to use to append connection URL  "
+              "when chaining multiple pifpaf instances (default: PIFPAF_URLS)")
+@click.option("--socket", envvar="PIFPAF_AGENT_SOCKET",
+              help="Socket of the pifpaf agent",
+              type=click.Path(dir_okay=False))
+@click.pass_context
+def lease(ctx, env_prefix, global_urls_variable, socket):
+    _setup_logging(ctx)
     ctx.obj['env_prefix'] = ctx.obj.get('env_prefix', env_prefix)
     ctx.obj['global_urls_variable'] = ctx.obj.get('global_urls_variable',
                                                   global_urls_variable)
+    ctx.obj['socket'] = socket
+
+
+@main.command(name="agent",
+              help="Keep daemons started to lease them with `pifpaf lease`")
+@click.option("--socket", envvar="PIFPAF_AGENT_SOCKET",
+              help="Socket to listen on",
+              type=click.Path(dir_okay=False))
+@click.option("--pool", "pools", multiple=True, metavar="DAEMON[=SIZE]",
+              help="Daemon to keep started before it is leased, "
+              "with the default options")
+@click.option("--size", type=int, default=1,
+              help="Number of instances to keep started for each pool "
+              "(default: 1)")
+@click.option("--jobs", "-j", type=int,
+              help="Maximum number of daemons to start or stop at the same "
+              "time")
+@click.pass_context
+def agent_(ctx, socket, pools, size, jobs):
+    from pifpaf import agent
+
+    _setup_logging(ctx)
+    debug = ctx.obj['debug']
+    pool_sizes = []
+    for pool in pools:
+        name, _, pool_size = pool.partition("=")
+        _check_daemon(name, "'--pool'")
+        pool_sizes.append((name, int(pool_size) if pool_size else size))
+
+    a = agent.Agent(socket or agent.get_default_socket_path(create=True),
+                    _get_daemon, pools=pool_sizes, size=size, jobs=jobs,
+                    debug=debug)
+
+    def _stop(signum, frame):
+        raise KeyboardInterrupt
+
+    signal.signal(signal.SIGTERM, _stop)
+    signal.signal(signal.SIGHUP, _stop)
+    a.start()
+    LOG.info("pifpaf agent listening on %s", a.path)
+    try:
+        a.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        a.stop()
+
+
+@main.command(name="bench-drivers",
+              help="Measure how long the daemons take to start and stop")
+@click.option("--repeat", "-n", type=int, default=5,
+              help="Number of times to start each daemon (default: 5)")
+@click.option("--variants/--no-variants", default=True,
+              help="Also measure the main option combinations, "
+              "e.g. redis --sentinel (default: yes)")
+@click.option("--output", "-o", type=click.Path(dir_okay=False),
+              help="Write the results to this JSON file")
+@click.option("--compare", "reference", type=click.Path(exists=True,
+                                                        dir_okay=False),
+              help="Compare the startup times with the ones of a file "
+              "written by --output")
+@click.argument("daemons", nargs=-1)
+@click.pass_context
+def bench_drivers(ctx, repeat, variants, output, reference, daemons):
+    from pifpaf import bench
+
+    _setup_logging(ctx)
+    for name in daemons:
+        _check_daemon(name, "'DAEMONS'")
+    benchmarks = bench.get_benchmarks(daemons or _daemons_names(),
+                                      _get_daemon, variants=variants,
+                                      debug=ctx.obj['debug'])
+    results = []
+    for b in benchmarks:
+        LOG.info("benchmarking %s", b)
+        results.append(b.run(repeat))
+
+    changes = None
+    if reference:
+        changes = bench.compare(results, bench.load(reference))
+    for line in bench.format_table(results, changes):
+        click.echo(line)
+    if output:
+        bench.save(output, results)
 
 
 def run_main():
-    return main.main(standalone_mode=False)
+    try:
+        return main.main(standalone_mode=False)
+    except click.ClickException as e:
+        # Not in standalone mode, so that `run` can return the status of its
+        # command: report usage errors like click does
+        e.show()
+        return e.exit_code
 
 
 if __name__ == '__main__':
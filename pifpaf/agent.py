@@ -0,0 +1,277 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import collections
+import concurrent.futures
+import contextlib
+import json
+import logging
+import os
+import socket
+import socketserver
+import stat
+import tempfile
+import threading
+
+import fixtures
+
+from pifpaf import drivers
+from pifpaf import util
+
+LOG = logging.getLogger(__name__)
+
+
+def _get_private_dir(create=False):
+    """Return a directory of the temporary directory only the user can use.
+
+    Any user can create files in the temporary directory, so the directory is
+    checked to be owned by the user and not accessible by others.
+    """
+    path = os.path.join(tempfile.gettempdir(), "pifpaf-agent-%d" % os.getuid())
+    if create:
+        try:
+            os.mkdir(path, 0o700)
+        except FileExistsError:
+            pass
+    try:
+        st = os.lstat(path)
+    except FileNotFoundError:
+        # No agent has been started
+        return path
+    if (not stat.S_ISDIR(st.st_mode) or st.st_uid != os.getuid() or
+            st.st_mode & 0o077):
+        raise RuntimeError("`%s' is not a private directory of the current "
+                           "user" % path)
+    return path
+
+
+def get_default_socket_path(create=False):
+    """Return the path of the agent socket.
+
+    Without XDG_RUNTIME_DIR, the socket is in a private directory of the
+    temporary directory, created if `create` is True.
+    """
+    path = os.getenv("PIFPAF_AGENT_SOCKET")
+    if path:
+        return path
+    runtime_dir = os.getenv("XDG_RUNTIME_DIR")
+    if runtime_dir:
+        return os.path.join(runtime_dir, "pifpaf-agent-%d.sock" % os.getuid())
+    return os.path.join(_get_private_dir(create), "agent.sock")
+
+
+class _Handler(socketserver.StreamRequestHandler):
+    def _send(self, response):
+        self.wfile.write(json.dumps(response).encode() + b"\n")
+        self.wfile.flush()
+
+    def handle(self):
+        agent = self.server.agent
+        try:
+            request = json.loads(self.rfile.readline())
+            driver = agent.lease(request["driver"],
+                                 request.get("options", {}),
+                                 request.get("env_prefix", "PIFPAF"))
+        except Exception as e:  # noqa: B902
+            LOG.error("Unable to lease: %s", util.format_error(e))
+            self._send({"error": util.format_error(e)})
+            return
+
+        try:
+            self._send({"env": driver.env})
+            # The lease lasts until the client closes the connection
+            while self.rfile.read(4096):
+                pass
+        finally:
+            agent.release(driver)
+
+
+class _Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+class Agent(object):
+    """Keep pools of started drivers and lease them over a Unix socket.
+
+    A pool is kept for each driver, options and environment prefix
+    combination that has been asked for, or given in `pools` as (driver
+    name, pool size) tuples. Once a lease ends, the driver is cleaned up and
+    a fresh one is started in the background to replace it.
+
+    The ports of the drivers that are not asked for are allocated, so
+    several instances of a pool can run at the same time.
+    """
+
+    def __init__(self, path, get_driver, pools=(), size=1, jobs=None,
+                 debug=False):
+        """Create a new agent."""
+        self.path = path
+        self.get_driver = get_driver
+        self.size = size
+        self.debug = debug
+        self._lock = threading.Lock()
+        self._stopping = False
+        self._sizes = {}
+        self._ready = collections.defaultdict(list)
+        self._starting = collections.Counter()
+        self._leased = set()
+        self._executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=jobs)
+        self._server = None
+        for name, pool_size in pools:
+            self._sizes[self._key(name, {}, "PIFPAF")] = pool_size
+
+    @staticmethod
+    def _key(name, options, env_prefix):
+        return json.dumps([name, options, env_prefix], sort_keys=True)
+
+    def _start(self, key):
+        name, options, env_prefix = json.loads(key)
+        plugin = self.get_driver(name)
+        for port in plugin.get_port_option_names():
+            options.setdefault(port, 0)
+        LOG.info("starting %s %s", name, options)
+        driver = plugin(env_prefix=env_prefix, debug=self.debug, **options)
+        # The drivers are set up concurrently, and their variables are only
+        # for the clients that lease them
+        with drivers.private_environ():
+            driver.setUp()
+        return driver
+
+    def _start_into_pool(self, key):
+        try:
+            driver = self._start(key)
+        except Exception as e:  # noqa: B902
+            LOG.error("Unable to start %s: %s", key, util.format_error(e))
+            driver = None
+        with self._lock:
+            self._starting[key] -= 1
+            if driver is not None and not self._stopping:
+                self._ready[key].append(driver)
+                driver = None
+        if driver is not None:
+            driver.cleanUp()
+
+    def _refill(self, key):
+        with self._lock:
+            if self._stopping:
+                return
+            missing = (self._sizes[key] - len(self._ready[key]) -
+                       self._starting[key])
+            for _ in range(missing):
+                self._starting[key] += 1
+                self._executor.submit(self._start_into_pool, key)
+
+    def _cleanup_driver(self, driver):
+        try:
+            driver.cleanUp()
+        except Exception:  # noqa: B902
+            LOG.error("Unable to clean up %s", driver, exc_info=True)
+
+    def lease(self, name, options=None, env_prefix="PIFPAF"):
+        """Return a started driver, taken from its pool if possible."""
+        key = self._key(name, options or {}, env_prefix)
+        with self._lock:
+            self._sizes.setdefault(key, self.size)
+            ready = self._ready[key]
+            driver = ready.pop(0) if ready else None
+        self._refill(key)
+        if driver is None:
+            LOG.info("pool of %s is empty, starting a new one", key)
+            driver = self._start(key)
+        with self._lock:
+            if not self._stopping:
+                self._leased.add(driver)
+                return driver
+        self._cleanup_driver(driver)
+        raise RuntimeError("pifpaf agent is stopping")
+
+    def release(self, driver):
+        """End a lease, the driver is cleaned up in the background."""
+        with self._lock:
+            # When the agent stops, it cleans up the leased drivers itself
+            if driver in self._leased:
+                self._leased.remove(driver)
+                self._executor.submit(self._cleanup_driver, driver)
+
+    def start(self):
+        """Start filling the pools and listen on the socket."""
+        with contextlib.suppress(FileNotFoundError):
+            os.unlink(self.path)
+        self._server = _Server(self.path, _Handler)
+        self._server.agent = self
+        for key in list(self._sizes):
+            self._refill(key)
+
+    def serve_forever(self):
+        self._server.serve_forever()
+
+    def stop(self):
+        """Stop listening and clean up all the drivers."""
+        with self._lock:
+            self._stopping = True
+            drivers = list(self._leased)
+            self._leased.clear()
+            for ready in self._ready.values():
+                drivers.extend(ready)
+                del ready[:]
+        if self._server is not None:
+            self._server.server_close()
+            with contextlib.suppress(FileNotFoundError):
+                os.unlink(self.path)
+        # Drivers still starting are cleaned up by _start_into_pool
+        for driver in drivers:
+            self._executor.submit(self._cleanup_driver, driver)
+        self._executor.shutdown(wait=True)
+
+
+class Lease(fixtures.Fixture):
+    """Lease a started driver from a pifpaf agent.
+
+    Like a driver, the environment variables of the leased instance are
+    set on setUp and available in `env`. The lease ends on cleanup.
+    """
+
+    def __init__(self, driver, options=None, env_prefix="PIFPAF",
+                 path=None):
+        """Create a new lease."""
+        super(Lease, self).__init__()
+        self.driver = driver
+        self.options = options or {}
+        self.env_prefix = env_prefix
+        self.path = path or get_default_socket_path()
+        self.env = {}
+
+    def _setUp(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.addCleanup(sock.close)
+        try:
+            sock.connect(self.path)
+        except OSError as e:
+            raise RuntimeError("Unable to connect to pifpaf agent on %s: %s"
+                               % (self.path, e))
+        sock.sendall(json.dumps({
+            "driver": self.driver,
+            "options": self.options,
+            "env_prefix": self.env_prefix,
+        }).encode() + b"\n")
+        with sock.makefile("rb") as f:
+            line = f.readline()
+        if not line:
+            raise RuntimeError("pifpaf agent closed the connection")
+        response = json.loads(line)
+        if "error" in response:
+            raise RuntimeError(response["error"])
+        for key, value in response["env"].items():
+            self.env[key] = value
+            self.useFixture(fixtures.EnvironmentVariable(key, value))
@@ -0,0 +1,271 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import importlib.metadata
+import json
+import logging
+import os
+import platform
+import threading
+import time
+
+import psutil
+
+from pifpaf import tracing
+from pifpaf import util
+
+LOG = logging.getLogger(__name__)
+
+# Option combinations benchmarked in addition to the defaults
+VARIANTS = {
+    "etcd": [{"cluster": True}],
+    "postgresql": [{"sync": True}],
+    "rabbitmq": [{"cluster": True}],
+    "redis": [{"sentinel": True}],
+    "valkey": [{"sentinel": True}],
+}
+
+# Phases of the spans spent waiting for the daemons to be ready
+READINESS_PHASES = ("wait_for_line", "wait_until_ready")
+
+
+def percentile(values, percent):
+    """Return the `percent` percentile of `values`, interpolated."""
+    values = sorted(values)
+    if not values:
+        return None
+    rank = (len(values) - 1) * percent / 100.0
+    low = int(rank)
+    high = min(low + 1, len(values) - 1)
+    return values[low] + (values[high] - values[low]) * (rank - low)
+
+
+def format_options(options):
+    """Write options the way they are given on the command line."""
+    args = []
+    for key, value in sorted(options.items()):
+        key = key.replace("_", "-")
+        if value is True:
+            args.append("--%s" % key)
+        elif value is False:
+            args.append("--no-%s" % key)
+        else:
+            args.append("--%s=%s" % (key, value))
+    return " ".join(args)
+
+
+class _RSSSampler(threading.Thread):
+    """Record the peak memory used by the processes of a driver.
+
+    Daemons often leave the process tree of pifpaf, e.g. when they
+    daemonize, so the process groups of the commands run by the driver, and
+    its cgroup if any, are looked at too.
+    """
+
+    INTERVAL = 0.05
+
+    def __init__(self, driver):
+        """Create a new sampler."""
+        super(_RSSSampler, self).__init__(daemon=True)
+        self.driver = driver
+        self.peak = 0
+        self._pgids = set()
+        self._stop_event = threading.Event()
+
+    def _get_procs(self):
+        me = psutil.Process()
+        procs = dict((p.pid, p) for p in me.children(recursive=True))
+        # Each command run by the driver leads its own process group
+        self._pgids.update(p.pid for p in me.children())
+        self._pgids.update(s["args"]["pid"] for s in tracing.get_spans()
+                           if s["phase"] == "exec" and "pid" in s["args"])
+        for p in util._get_procs_of_pgids(self._pgids):
+            procs.setdefault(p.pid, p)
+        if self.driver.cgroup is not None:
+            for pid in self.driver.cgroup.pids():
+                if pid not in procs:
+                    try:
+                        procs[pid] = psutil.Process(pid)
+                    except psutil.NoSuchProcess:
+                        pass
+        return procs.values()
+
+    def sample(self):
+        rss = 0
+        for p in self._get_procs():
+            try:
+                rss += p.memory_info().rss
+            except psutil.Error:
+                pass
+        self.peak = max(self.peak, rss)
+
+    def run(self):
+        while not self._stop_event.wait(self.INTERVAL):
+            self.sample()
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+        self.sample()
+
+
+class Benchmark(object):
+    """Start and stop a driver several times and measure it.
+
+    Each run measures the time `setUp` takes (startup), the part of it spent
+    waiting for the daemons to be ready (readiness, summed over all the
+    waits), the time `cleanUp` takes (teardown) and the peak RSS of the child
+    processes while the driver is up.
+    """
+
+    def __init__(self, name, plugin, options=None, debug=False):
+        """Create a new benchmark."""
+        self.name = name
+        self.plugin = plugin
+        self.options = options or {}
+        self.debug = debug
+
+    def __str__(self):
+        """Describe the benchmark."""
+        return " ".join(filter(None, (self.name,
+                                      format_options(self.options))))
+
+    def run_once(self):
+        driver = self.plugin(debug=self.debug, **self.options)
+        # Tracing may have been enabled by the user, keep it and its spans
+        was_enabled = tracing.is_enabled()
+        first_span = len(tracing.get_spans())
+        tracing.enable()
+        sampler = _RSSSampler(driver)
+        sampler.start()
+        start = time.perf_counter()
+        try:
+            driver.setUp()
+        finally:
+            startup = time.perf_counter() - start
+            spans = tracing.get_spans()[first_span:]
+            if not was_enabled:
+                tracing.disable()
+            sampler.stop()
+        start = time.perf_counter()
+        driver.cleanUp()
+        return {
+            "startup": startup,
+            "readiness": sum(s["duration"] for s in spans
+                             if s["phase"] in READINESS_PHASES),
+            "teardown": time.perf_counter() - start,
+            "peak_rss": sampler.peak,
+        }
+
+    def run(self, repeat=5):
+        """Run the benchmark `repeat` times and return the statistics.
+
+        The benchmark stops at the first failure, reported as `error`.
+        """
+        result = {
+            "driver": self.name,
+            "options": self.options,
+            "runs": 0,
+        }
+        runs = []
+        for _ in range(repeat):
+            try:
+                runs.append(self.run_once())
+            except Exception as e:  # noqa: B902
+                LOG.debug("%s failed", self, exc_info=True)
+                result["error"] = util.format_error(e)
+                break
+        result["runs"] = len(runs)
+        if runs:
+            for key in ("startup", "readiness", "teardown"):
+                values = [run[key] for run in runs]
+                result[key] = {
+                    "p50": percentile(values, 50),
+                    "p95": percentile(values, 95),
+                }
+            result["peak_rss"] = max(run["peak_rss"] for run in runs)
+        return result
+
+
+def get_benchmarks(daemons, get_driver, variants=True, debug=False):
+    """Return the benchmarks of the `daemons` names."""
+    benchmarks = []
+    for name in daemons:
+        plugin = get_driver(name)
+        benchmarks.append(Benchmark(name, plugin, debug=debug))
+        if variants:
+            for options in VARIANTS.get(name, ()):
+                benchmarks.append(Benchmark(name, plugin, options, debug))
+    return benchmarks
+
+
+def save(path, results):
+    """Write the results with a description of where they come from."""
+    with open(path, "w") as f:
+        json.dump({
+            "pifpaf": importlib.metadata.distribution("pifpaf").version,
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpus": os.cpu_count(),
+            "date": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+            "results": results,
+        }, f, indent=2, sort_keys=True)
+
+
+def load(path):
+    with open(path) as f:
+        return json.load(f)
+
+
+def _key(result):
+    return result["driver"], format_options(result["options"])
+
+
+def compare(results, reference):
+    """Return the relative change of the startup p50 of each benchmark.
+
+    `reference` is the content of a file written by `save`; benchmarks that
+    are not in both are ignored.
+    """
+    previous = dict((_key(r), r) for r in reference["results"]
+                    if r.get("startup"))
+    changes = {}
+    for result in results:
+        old = previous.get(_key(result))
+        if old is not None and result.get("startup"):
+            changes[_key(result)] = (
+                result["startup"]["p50"] / old["startup"]["p50"] - 1)
+    return changes
+
+
+def format_table(results, changes=None):
+    """Return the results as lines of a table, durations in milliseconds."""
+    lines = ["%-30s %17s %17s %17s %9s%s" % (
+        "daemon", "startup p50/p95", "ready p50/p95", "teardown p50/p95",
+        "RSS MiB", " vs ref" if changes is not None else "")]
+    for result in results:
+        name = " ".join(filter(None, _key(result)))
+        if not result["runs"]:
+            lines.append("%-30s %s" % (name, result.get("error")))
+            continue
+        columns = ["%-30s" % name]
+        for key in ("startup", "readiness", "teardown"):
+            columns.append("%8.0f/%8.0f" % (result[key]["p50"] * 1000,
+                                            result[key]["p95"] * 1000))
+        columns.append("%9.1f" % (result["peak_rss"] / 2.0**20))
+        if changes is not None:
+            change = changes.get(_key(result))
+            columns.append("%+6.1f%%" % (change * 100)
+                           if change is not None else "     -")
+        lines.append(" ".join(columns))
+    return lines
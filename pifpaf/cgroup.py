@@ -0,0 +1,236 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import logging
+import os
+import signal
+import tempfile
+
+import fixtures
+
+from pifpaf import util
+
+LOG = logging.getLogger(__name__)
+
+CONTROLLERS = ("cpu", "memory", "io", "pids")
+
+# Leaf cgroup the current process is moved into, see `get_parent`
+SELF_CGROUP = "pifpaf-self"
+
+
+def _get_mountpoint():
+    try:
+        with open("/proc/self/mountinfo") as f:
+            for line in f:
+                fields = line.split()
+                # Optional fields are ended by a "-" field, followed by the
+                # filesystem type
+                if fields[fields.index("-") + 1] == "cgroup2":
+                    return fields[4]
+    except FileNotFoundError:
+        pass
+
+
+def get_current():
+    """Return the path of the cgroup v2 of the current process.
+
+    Return None if cgroup v2 is not available.
+    """
+    mountpoint = _get_mountpoint()
+    if mountpoint is None:
+        return
+    with open("/proc/self/cgroup") as f:
+        for line in f:
+            hierarchy, _, path = line.rstrip("\n").split(":", 2)
+            if hierarchy == "0":
+                return os.path.join(mountpoint, path.lstrip("/"))
+
+
+def get_parent():
+    """Return the cgroup v2 where to create the cgroups of the daemons.
+
+    Controllers can only be enabled for the children of a cgroup that
+    contains no process itself, except for the root cgroup: the current
+    process is moved into a `pifpaf-self` leaf sub-cgroup, and the cgroup it
+    was in is returned. Return None if cgroup v2 is not available.
+    """
+    current = get_current()
+    if current is None:
+        return
+    if os.path.basename(current.rstrip("/")) == SELF_CGROUP:
+        return os.path.dirname(current.rstrip("/"))
+    if (not is_delegated(current) or
+            os.path.samefile(current, _get_mountpoint())):
+        return current
+    leaf = os.path.join(current, SELF_CGROUP)
+    try:
+        os.makedirs(leaf, exist_ok=True)
+        with open(os.path.join(leaf, "cgroup.procs"), "w") as f:
+            f.write("0")
+    except OSError as e:
+        LOG.debug("Unable to move pifpaf into %s: %s", leaf, e)
+    return current
+
+
+def is_delegated(path):
+    """Check if sub-cgroups can be created and processes moved into them."""
+    return (path is not None and
+            os.access(path, os.W_OK) and
+            os.access(os.path.join(path, "cgroup.procs"), os.W_OK))
+
+
+def parse_limits(limits):
+    """Parse limits written as `memory.max=1G,pids.max=100`."""
+    result = {}
+    for limit in filter(None, (limits or "").split(",")):
+        key, sep, value = limit.partition("=")
+        if not sep:
+            raise ValueError("Invalid cgroup limit `%s'" % limit)
+        result[key.strip()] = value.strip()
+    return result
+
+
+class Cgroup(fixtures.Fixture):
+    """Create a cgroup v2 to contain a process tree.
+
+    Processes are placed into the cgroup by calling `attach` from the
+    process itself, e.g. as `preexec_fn`. On cleanup, all the processes left
+    in the cgroup are killed at once, whatever they did to escape their
+    process group and parent, and the cgroup is removed.
+
+    `limits` is a dict of cgroup interface files to set, e.g.
+    {"memory.max": "1G"}.
+    """
+
+    def __init__(self, parent=None, prefix="pifpaf-", limits=None):
+        """Create a new cgroup."""
+        super(Cgroup, self).__init__()
+        self.parent = parent or get_parent()
+        self.prefix = prefix
+        self.limits = limits or {}
+        self.path = None
+
+    def _setUp(self):
+        if not is_delegated(self.parent):
+            raise RuntimeError("cgroup v2 `%s' is not writable"
+                               % self.parent)
+        self._enable_controllers()
+        self.path = tempfile.mkdtemp(prefix=self.prefix, dir=self.parent)
+        self.addCleanup(self._remove)
+        for key, value in self.limits.items():
+            # The interface files only exist once the controller is enabled
+            if not os.path.exists(os.path.join(self.path, key)):
+                raise RuntimeError(
+                    "Unable to set `%s': cgroup v2 controller `%s' is not "
+                    "enabled in `%s'" % (key, key.partition(".")[0],
+                                         self.parent))
+            self._write(key, value)
+
+    def _enable_controllers(self):
+        try:
+            with open(os.path.join(self.parent,
+                                   "cgroup.controllers")) as f:
+                available = set(f.read().split())
+        except OSError:
+            return
+        for controller in CONTROLLERS:
+            if controller not in available:
+                continue
+            try:
+                with open(os.path.join(self.parent,
+                                       "cgroup.subtree_control"), "w") as f:
+                    f.write("+%s" % controller)
+            except OSError as e:
+                # EBUSY: the parent contains other processes, only the
+                # controller-less accounting (cpu.stat) is available then
+                LOG.debug("Unable to enable %s controller in %s: %s",
+                          controller, self.parent, e)
+
+    def _write(self, name, value):
+        with open(os.path.join(self.path, name), "w") as f:
+            f.write(str(value))
+
+    def _read(self, name):
+        try:
+            with open(os.path.join(self.path, name)) as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def attach(self, pid=0):
+        """Move a process (by default the current one) into the cgroup."""
+        self._write("cgroup.procs", pid)
+
+    def pids(self):
+        return [int(pid) for pid in (self._read("cgroup.procs") or "").split()]
+
+    def is_populated(self):
+        for line in (self._read("cgroup.events") or "").splitlines():
+            key, value = line.split()
+            if key == "populated":
+                return value == "1"
+        return bool(self.pids())
+
+    def kill(self):
+        """Kill all the processes of the cgroup and its descendants."""
+        try:
+            # Linux >= 5.14
+            self._write("cgroup.kill", 1)
+        except (FileNotFoundError, PermissionError):
+            for pid in self.pids():
+                try:
+                    os.kill(pid, signal.SIGKILL)
+                except ProcessLookupError:
+                    pass
+
+    def get_usage(self):
+        """Return the resources used by the processes of the cgroup.
+
+        The keys are `cpu_seconds`, `user_seconds`, `system_seconds`,
+        `memory_bytes` (peak usage when available), `io_read_bytes` and
+        `io_write_bytes`; the ones whose controller is not enabled are
+        missing.
+        """
+        usage = {}
+        names = {
+            "usage_usec": "cpu_seconds",
+            "user_usec": "user_seconds",
+            "system_usec": "system_seconds",
+        }
+        for line in (self._read("cpu.stat") or "").splitlines():
+            key, value = line.split()
+            if key in names:
+                usage[names[key]] = int(value) / 1000000.0
+        memory = self._read("memory.peak") or self._read("memory.current")
+        if memory is not None:
+            usage["memory_bytes"] = int(memory)
+        io = self._read("io.stat")
+        if io is not None:
+            usage["io_read_bytes"] = usage["io_write_bytes"] = 0
+            for line in io.splitlines():
+                for stat in line.split()[1:]:
+                    key, value = stat.split("=")
+                    if key == "rbytes":
+                        usage["io_read_bytes"] += int(value)
+                    elif key == "wbytes":
+                        usage["io_write_bytes"] += int(value)
+        return usage
+
+    def _remove(self):
+        LOG.info("%s resources usage: %s", self.path, self.get_usage())
+        if self.is_populated():
+            self.kill()
+            if not util.wait_for(lambda: not self.is_populated(), 10):
+                LOG.warning("Processes of %s survive SIGKILL", self.path)
+                return
+        os.rmdir(self.path)
@@ -11,24 +11,30 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import concurrent.futures
 import contextlib
+import copy
+import fcntl
+import functools
+import hashlib
 import logging
 import os
 import re
-import select
+import selectors
 import shutil
 import socket
 import subprocess
 import sys
+import tempfile
 import threading
-import time
 
 import fixtures
 
-import jinja2
-
 import psutil
 
+from pifpaf import cgroup
+from pifpaf import probes
+from pifpaf import tracing
 from pifpaf import util
 
 
@@ -41,71 +47,623 @@ except ImportError:
 LOG = logging.getLogger(__name__)
 
 
+class _Output(object):
+    """Output of a program, read by the output multiplexer."""
+
+    def __init__(self, app, pid, pattern=None, collect=False):
+        """Create a new program output."""
+        self.app = app
+        self.pid = pid
+        self.pattern = pattern
+        self.collect = collect
+        self.lines = []
+        # Number of lines until the pattern has been printed
+        self.match = None
+        self.eof = False
+        self._buffer = b""
+        self._cond = threading.Condition()
+
+    def feed(self, data):
+        lines = (self._buffer + data).splitlines(True)
+        if lines and not lines[-1].endswith(b"\n"):
+            self._buffer = lines.pop()
+        else:
+            self._buffer = b""
+        self._add_lines(lines)
+
+    def feed_eof(self):
+        self._add_lines([self._buffer] if self._buffer else [], eof=True)
+        self._buffer = b""
+
+    def _add_lines(self, lines, eof=False):
+        for line in lines:
+            Driver._log_output(self.app, self.pid, line)
+        with self._cond:
+            for line in lines:
+                if self.collect:
+                    self.lines.append(line)
+                if (self.pattern and self.match is None and
+                        re.search(self.pattern, os.fsdecode(line))):
+                    self.match = len(self.lines)
+                    if not self.collect:
+                        break
+            self.eof = self.eof or eof
+            self._cond.notify_all()
+
+    def wait_for_match(self):
+        """Wait for the pattern to be printed, return False on EOF."""
+        with self._cond:
+            self._cond.wait_for(lambda: self.match is not None or self.eof)
+            return self.match is not None
+
+    def wait_for_eof(self, timeout=None):
+        with self._cond:
+            return self._cond.wait_for(lambda: self.eof, timeout)
+
+    def wait_for_line_after_match(self, timeout):
+        """Return the first line printed after the pattern, if any."""
+        with self._cond:
+            self._cond.wait_for(
+                lambda: len(self.lines) > self.match or self.eof, timeout)
+            if len(self.lines) > self.match:
+                return self.lines[self.match]
+
+    def get_output(self, end=None):
+        with self._cond:
+            return b"".join(self.lines[:end])
+
+    def stop_collecting(self):
+        with self._cond:
+            self.collect = False
+            self.lines = []
+
+
+class _OutputMultiplexer(object):
+    """Read the output of all programs from a single thread."""
+
+    def __init__(self):
+        """Create a new output multiplexer."""
+        self._selector = selectors.DefaultSelector()
+        self._wakeup_r, self._wakeup_w = os.pipe()
+        os.set_blocking(self._wakeup_r, False)
+        os.set_blocking(self._wakeup_w, False)
+        self._selector.register(self._wakeup_r, selectors.EVENT_READ)
+        self._requests = []
+        self._lock = threading.Lock()
+        self._thread = threading.Thread(target=self._run,
+                                        name="pifpaf-output")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _request(self, *request):
+        # The selector is only modified from its own thread
+        with self._lock:
+            self._requests.append(request)
+        try:
+            os.write(self._wakeup_w, b"\0")
+        except BlockingIOError:
+            pass
+
+    def register(self, stream, output):
+        os.set_blocking(stream.fileno(), False)
+        self._request("register", stream, output)
+
+    def release(self, stream):
+        """Stop reading `stream` once what is available has been read."""
+        self._request("release", stream, None)
+
+    def _run(self):
+        while True:
+            for key, events in self._selector.select():
+                if key.data is None:
+                    self._process_requests()
+                else:
+                    self._read(key.fileobj, key.data)
+
+    def _process_requests(self):
+        try:
+            while os.read(self._wakeup_r, 4096):
+                pass
+        except BlockingIOError:
+            pass
+        with self._lock:
+            requests, self._requests = self._requests, []
+        for action, stream, output in requests:
+            if action == "register":
+                self._selector.register(stream, selectors.EVENT_READ,
+                                        output)
+            else:
+                try:
+                    output = self._selector.get_key(stream).data
+                except (KeyError, ValueError):
+                    # Already closed
+                    continue
+                while not self._read(stream, output):
+                    pass
+                if not stream.closed:
+                    self._close(stream, output)
+
+    def _read(self, stream, output):
+        """Read available data, return True if nothing more is available."""
+        try:
+            data = os.read(stream.fileno(), 65536)
+        except BlockingIOError:
+            return True
+        except OSError:
+            data = b""
+        if data:
+            output.feed(data)
+            return False
+        self._close(stream, output)
+        return True
+
+    def _close(self, stream, output):
+        self._selector.unregister(stream)
+        stream.close()
+        output.feed_eof()
+
+
+_multiplexer = None
+_multiplexer_lock = threading.Lock()
+
+
+def _get_multiplexer():
+    global _multiplexer
+    with _multiplexer_lock:
+        if _multiplexer is None:
+            _multiplexer = _OutputMultiplexer()
+        return _multiplexer
+
+
+def _reset_multiplexer():
+    # The multiplexer thread does not survive fork()
+    global _multiplexer
+    _multiplexer = None
+
+
+os.register_at_fork(after_in_child=_reset_multiplexer)
+
+# Environment variables exported by the drivers set up in a thread, when they
+# must not change os.environ
+_thread_environ = threading.local()
+
+
+@contextlib.contextmanager
+def private_environ(environ=None):
+    """Keep the drivers set up in this thread from changing `os.environ`.
+
+    `os.environ` is shared by all the threads, so drivers set up
+    concurrently must only export their variables in their `env` and to the
+    processes they start; the caller exports them once they are set up.
+    `environ` are the variables already exported for these drivers.
+    """
+    old = getattr(_thread_environ, "value", None)
+    _thread_environ.value = dict(environ or {})
+    try:
+        yield
+    finally:
+        _thread_environ.value = old
+
+
+def _get_thread_environ():
+    return getattr(_thread_environ, "value", None)
+
+
+def _call_with_private_environ(environ, func):
+    with private_environ(environ):
+        return func()
+
+
+# Directory where the ports allocated by the running pifpaf are locked
+PORTS_LOCK_DIR = os.path.join(tempfile.gettempdir(), "pifpaf-ports")
+
+# Number of times a driver using allocated ports is started again when a port
+# is taken by someone else in the meantime
+PORT_CONFLICT_RETRIES = 3
+
+_PORT_CONFLICT_RE = re.compile(
+    r"address already in use|EADDRINUSE|port \d+ is already in use",
+    re.IGNORECASE)
+
+
+def _lock_free_port():
+    """Find a free TCP port and lock it for other pifpaf processes.
+
+    Return the port and the file descriptor holding the lock.
+    """
+    try:
+        os.makedirs(PORTS_LOCK_DIR, exist_ok=True)
+        os.chmod(PORTS_LOCK_DIR, 0o1777)
+    except PermissionError:
+        # Created by another user
+        pass
+    for _ in range(100):
+        with contextlib.closing(
+                socket.socket(socket.AF_INET, socket.SOCK_STREAM)) as sock:
+            sock.bind(("", 0))
+            port = sock.getsockname()[1]
+        try:
+            fd = os.open(os.path.join(PORTS_LOCK_DIR, str(port)),
+                         os.O_RDONLY | os.O_CREAT, 0o666)
+        except PermissionError:
+            continue
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            # Allocated by another pifpaf, not listening yet
+            os.close(fd)
+            continue
+        return port, fd
+    raise RuntimeError("Unable to find a free port")
+
+
+# Memory-backed directories where to put data with the `memory` storage
+MEMORY_STORAGE_DIRS = ("/dev/shm",)
+
+
+def _supports_xattr(filename):
+    if xattr is None:
+        return False
+    try:
+        # PyPI: xattr
+        if hasattr(xattr, 'xattr'):
+            x = xattr.xattr(filename)
+            x[b"user.test"] = b"test"
+        # PyPI: pyxattr
+        else:
+            xattr.setxattr(filename, 'user.test', 'test')
+    except (OSError, IOError) as e:
+        if e.errno != 95:
+            raise
+        return False
+    return True
+
+
+def _is_port_conflict(e):
+    if isinstance(e, fixtures.MultipleExceptions):
+        return any(_is_port_conflict(value) for _, value, _ in e.args)
+    return bool(_PORT_CONFLICT_RE.search(str(e)))
+
+
 class Driver(fixtures.Fixture):
+
+    # Default number of seconds to wait for a program to be ready
+    DEFAULT_WAIT_TIMEOUT = 60
+
+    # Estimation of the number of bytes written in the data directory by a
+    # freshly started daemon, checked before putting it in memory
+    STORAGE_SIZE = 64 * 1024 * 1024
+
+    # Whether the data directory must support extended attributes
+    REQUIRES_XATTR = False
+
     def __init__(self, env_prefix="PIFPAF", templatedir=".", debug=False,
-                 tmp_rootdir=None):
+                 tmp_rootdir=None, cache_dir=None,
+                 wait_timeout=DEFAULT_WAIT_TIMEOUT, use_cgroup=None,
+                 cgroup_limits=None, storage=None):
         """Create a new driver."""
         super(Driver, self).__init__()
+        self.wait_timeout = wait_timeout
         self.env_prefix = env_prefix
         self.env = {}
         self.debug = debug
         self.tmp_rootdir = tmp_rootdir
-
-        templatedir = os.path.join('drivers', 'templates', templatedir)
-        self.template_env = jinja2.Environment(
-            loader=jinja2.PackageLoader('pifpaf', templatedir))
+        self.cache_dir = cache_dir or os.getenv("PIFPAF_CACHE_DIR")
+        self.storage = storage or os.getenv("PIFPAF_STORAGE", "disk")
+        if self.storage not in ("disk", "memory"):
+            raise ValueError("Unknown storage `%s'" % self.storage)
+        if use_cgroup is None:
+            use_cgroup = os.getenv("PIFPAF_CGROUP", "").lower() not in (
+                "", "0", "false", "no", "off")
+        self.use_cgroup = use_cgroup
+        if cgroup_limits is None:
+            cgroup_limits = cgroup.parse_limits(
+                os.getenv("PIFPAF_CGROUP_LIMITS"))
+        self.cgroup_limits = cgroup_limits
+        # The cgroup containing all the processes of the driver, if any
+        self.cgroup = None
+        # Processes started in the current _stop_together block
+        self._kill_batch = None
+        self._kill_batch_lock = threading.Lock()
+        # Name of the port attributes allocated by _allocate_ports
+        self._allocated_ports = set()
+
+        self.templatedir = os.path.join('drivers', 'templates', templatedir)
+        self._template_env = None
 
     def _setUp(self):
-        self.tempdir = self.useFixture(fixtures.TempDir(self.tmp_rootdir)).path
+        if self.use_cgroup:
+            parent = cgroup.get_parent()
+            if cgroup.is_delegated(parent):
+                # Set up first so it is cleaned up last, once the processes
+                # had a chance to stop gracefully
+                self.cgroup = self.useFixture(cgroup.Cgroup(
+                    parent, "pifpaf-%s-" % self.__class__.__name__.lower(),
+                    self.cgroup_limits))
+            else:
+                LOG.warning("cgroup v2 `%s' is not writable, not using "
+                            "cgroups", parent)
+        self._allocate_ports(*self.get_port_option_names())
+        self.tempdir = self.useFixture(
+            fixtures.TempDir(self._get_tmp_rootdir())).path
         self.putenv("DATA", self.tempdir)
 
+    def _get_tmp_rootdir(self):
+        if self.storage != "memory" or self.tmp_rootdir is not None:
+            return self.tmp_rootdir
+        for path in MEMORY_STORAGE_DIRS:
+            if not os.access(path, os.W_OK):
+                continue
+            free = shutil.disk_usage(path).free
+            if free < self.STORAGE_SIZE:
+                LOG.warning("%s: only %d MiB free in %s, %d MiB needed",
+                            self.__class__.__name__, free // 2**20, path,
+                            self.STORAGE_SIZE // 2**20)
+                continue
+            if self.REQUIRES_XATTR:
+                with tempfile.NamedTemporaryFile(dir=path) as f:
+                    if not _supports_xattr(f.name):
+                        LOG.warning("%s: %s does not support xattr",
+                                    self.__class__.__name__, path)
+                        continue
+            return path
+        LOG.warning("%s: no memory-backed directory usable, storing data on "
+                    "disk", self.__class__.__name__)
+
+    def _get_state(self):
+        # Copy the containers, which _setUp may change in place
+        return dict((name, copy.copy(value)
+                     if isinstance(value, (dict, list, set)) else value)
+                    for name, value in self.__dict__.items())
+
+    def setUp(self):
+        with tracing.span(self.__class__.__name__, "setup"):
+            # _setUp may change the attributes given to the constructor, e.g.
+            # to point to the sub-drivers it started: each attempt starts
+            # from the state the driver had before the first one
+            state = self._get_state()
+            for attempt in range(PORT_CONFLICT_RETRIES):
+                if attempt:
+                    self.__dict__.clear()
+                    self.__dict__.update(state)
+                    state = self._get_state()
+                try:
+                    return super(Driver, self).setUp()
+                except Exception as e:  # noqa: B902
+                    if (not self._allocated_ports or
+                       attempt == PORT_CONFLICT_RETRIES - 1 or
+                       not _is_port_conflict(e)):
+                        raise
+                    LOG.warning("%s: port already in use, retrying with "
+                                "other ports", self.__class__.__name__)
+
+    def cleanUp(self, raise_first=True):
+        with tracing.span(self.__class__.__name__, "cleanup"):
+            return super(Driver, self).cleanUp(raise_first)
+
     @staticmethod
     def get_options():
         return []
 
+    @classmethod
+    def get_port_option_names(cls):
+        """Return the name of the arguments of the driver that are ports."""
+        names = []
+        for option in cls.get_options():
+            name = option["param_decls"][0].lstrip("-").replace("-", "_")
+            if name.endswith("port") and option.get("type") is int:
+                names.append(name)
+        return names
+
+    def _allocate_port(self):
+        """Return a free TCP port that no other pifpaf uses.
+
+        The port stays reserved for other pifpaf processes until the driver
+        is cleaned up.
+        """
+        port, fd = _lock_free_port()
+        self.addCleanup(os.close, fd)
+        return port
+
+    def _allocate_ports(self, *names):
+        """Set the port attributes `names` that are 0 to a free port."""
+        for name in names:
+            if getattr(self, name, None) == 0:
+                setattr(self, name, self._allocate_port())
+                self._allocated_ports.add(name)
+
+    def useFixtures(self, *fixtures):
+        """Use several independent fixtures, setting them up concurrently.
+
+        This is the same as calling `useFixture` on each of them, except that
+        their setup run in parallel. Once they are all set up, the environment
+        variables they export are the same as if they had been set up one
+        after the other, in order.
+        """
+        environ = _get_thread_environ()
+        errors = [None] * len(fixtures)
+
+        def _setup(i, fixture):
+            try:
+                with private_environ(environ):
+                    fixture.setUp()
+            except BaseException:  # noqa: B902
+                errors[i] = sys.exc_info()
+
+        threads = [threading.Thread(target=_setup, args=(i, fixture))
+                   for i, fixture in enumerate(fixtures)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        started = [fixture for fixture, error in zip(fixtures, errors)
+                   if error is None]
+        # They do not depend on each other, so stop them concurrently too
+        self.addCleanup(self._cleanup_fixtures, started)
+        for fixture in started:
+            for key, value in getattr(fixture, "env", {}).items():
+                self._export(key, value)
+
+        for error in errors:
+            if error is not None:
+                raise error[1].with_traceback(error[2])
+
+        return fixtures
+
+    @staticmethod
+    def _cleanup_fixtures(fixtures):
+        errors = []
+
+        def _cleanup(fixture):
+            try:
+                fixture.cleanUp()
+            except BaseException:  # noqa: B902
+                errors.append(sys.exc_info())
+
+        threads = [threading.Thread(target=_cleanup, args=(fixture,))
+                   for fixture in fixtures]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        if errors:
+            raise errors[0][1].with_traceback(errors[0][2])
+
+    def _export(self, key, value):
+        environ = _get_thread_environ()
+        if environ is None:
+            self.useFixture(fixtures.EnvironmentVariable(key, value))
+        else:
+            environ[key] = value
+
     def putenv(self, key, value, raw=False):
         if not raw:
             key = self.env_prefix + "_" + key
         self.env[key] = value
-        return self.useFixture(fixtures.EnvironmentVariable(key, value))
+        self._export(key, value)
 
     def _ensure_xattr_support(self):
         testfile = os.path.join(self.tempdir, "test")
         self._touch(testfile)
-        xattr_supported = False
-        if xattr is not None:
-            try:
-                # PyPI: xattr
-                if hasattr(xattr, 'xattr'):
-                    x = xattr.xattr(testfile)
-                    x[b"user.test"] = b"test"
-                # PyPI: pyxattr
-                else:
-                    xattr.setxattr(testfile, 'user.test', 'test')
-            except (OSError, IOError) as e:
-                if e.errno != 95:
-                    raise
-            else:
-                xattr_supported = True
-
-        if not xattr_supported:
+        if not _supports_xattr(testfile):
             raise RuntimeError("TMPDIR must support xattr for %s" %
                                self.__class__.__name__)
 
-    def _kill(self, parent):
-        log_thread = getattr(parent, "_log_thread", None)
+    @contextlib.contextmanager
+    def _stop_together(self):
+        """Stop the processes started in this block at once.
+
+        On cleanup, they are all terminated at once and waited for together,
+        instead of one after the other in the reverse order they started.
+        They must not depend on each other to stop.
+        """
+        batch = []
+        self.addCleanup(self._kill, batch)
+        self._kill_batch = batch
+        try:
+            yield
+        finally:
+            self._kill_batch = None
+
+    def _add_process(self, process):
+        """Register a process to stop when the driver is cleaned up."""
+        with self._kill_batch_lock:
+            if self._kill_batch is not None:
+                self._kill_batch.append(process)
+                return
+        self.addCleanup(self._kill, [process])
 
-        util.process_cleaner(parent)
+    @staticmethod
+    def _concurrently(*funcs):
+        """Call functions in parallel and return their results.
+
+        Once they all returned, the first error raised, if any, is raised
+        again. This is useful to run independent commands with `_exec`.
+        """
+        environ = _get_thread_environ()
+        if environ is not None:
+            funcs = [functools.partial(_call_with_private_environ,
+                                       environ, func) for func in funcs]
+        with concurrent.futures.ThreadPoolExecutor(
+                max_workers=max(len(funcs), 1)) as executor:
+            futures = [executor.submit(func) for func in funcs]
+        return [future.result() for future in futures]
+
+    def _kill(self, parents):
+        if not parents:
+            return
+
+        with tracing.span(" ".join(os.path.basename(p.args[0])
+                                   for p in parents), "kill",
+                          pids=[p.pid for p in parents]):
+            util.process_cleaner(*parents)
+
+        for parent in parents:
+            if getattr(parent, "_pifpaf_output", None) is not None:
+                # Parent process have been killed, don't wait for processes
+                # that might have inherited its output to close it
+                _get_multiplexer().release(parent.stdout)
 
-        if log_thread:
-            # Parent process have been killed
-            log_thread.join(timeout=3)
-            if log_thread.is_alive():
-                LOG.warning("logging thread for `%s` is still alive", parent)
+    @staticmethod
+    def _executable_fingerprint(filename, extra_paths=[]):
+        """Return a tuple identifying the installed version of a binary."""
+        loc = Driver.find_executable(filename, extra_paths)
+        if loc is None:
+            return (filename, None)
+        loc = os.path.realpath(loc)
+        st = os.stat(loc)
+        return (loc, st.st_size, st.st_mtime)
+
+    def _bootstrap_cached(self, name, key, datadir, bootstrap):
+        """Populate `datadir` by calling `bootstrap`, using a snapshot cache.
+
+        `key` must identify everything the result of `bootstrap` depends on,
+        such as the binary version and the generated configuration. When a
+        cache directory is configured and a snapshot matching `key` exists, it
+        is cloned into `datadir` and `bootstrap` is not called. Otherwise,
+        `bootstrap` is called and its result is stored for the next runs.
+
+        Return the path the snapshot was taken from when it has been restored
+        from the cache, so the caller can fix absolute paths if needed, or
+        None if `bootstrap` has been called.
+        """
+        if not self.cache_dir:
+            bootstrap()
+            return
+
+        digest = hashlib.sha256(repr(key).encode()).hexdigest()[:16]
+        snapshot = os.path.join(self.cache_dir, "%s-%s" % (name, digest))
+
+        if os.path.isdir(snapshot):
+            LOG.debug("restoring %s from snapshot %s", datadir, snapshot)
+            util.clone_tree(os.path.join(snapshot, "data"), datadir)
+            with open(os.path.join(snapshot, "origin")) as f:
+                return f.read()
+
+        bootstrap()
+
+        os.makedirs(self.cache_dir, exist_ok=True)
+        tmp = tempfile.mkdtemp(prefix=".%s-" % name, dir=self.cache_dir)
+        try:
+            os.mkdir(os.path.join(tmp, "data"))
+            util.clone_tree(datadir, os.path.join(tmp, "data"))
+            with open(os.path.join(tmp, "origin"), "w") as f:
+                f.write(datadir)
+            # rename is atomic, so concurrent runs either see a complete
+            # snapshot or none at all.
+            os.rename(tmp, snapshot)
+        except OSError:
+            shutil.rmtree(tmp, ignore_errors=True)
+        else:
+            LOG.debug("stored %s as snapshot %s", datadir, snapshot)
 
     @staticmethod
     def find_executable(filename, extra_paths):
-        paths = extra_paths + os.getenv('PATH', os.defpath).split(os.pathsep)
+        environ = _get_thread_environ() or os.environ
+        paths = extra_paths + environ.get(
+            'PATH', os.getenv('PATH', os.defpath)).split(os.pathsep)
         for path in paths:
             loc = shutil.which(filename, path=path)
             if loc is not None:
@@ -126,31 +684,41 @@ class Driver(fixtures.Fixture):
                 return fullpath
         raise RuntimeError("Configuration file `%s' not found" % filename)
 
-    def _read_in_bg(self, app, pid, fd):
-        while True:
-            data = fd.readline()
-            if not data:
-                break
-            self._log_output(app, pid, data)
-        fd.close()
-
     @staticmethod
     def _log_output(appname, pid, data):
         data = os.fsdecode(data)
         LOG.debug("%s[%d] output: %s", appname, pid, data.rstrip())
 
+    def _preexec(self):
+        os.setsid()
+        if self.cgroup is not None:
+            self.cgroup.attach()
+
+    def get_resource_usage(self):
+        """Return the resources used by the processes of the driver.
+
+        See `pifpaf.cgroup.Cgroup.get_usage`. None is returned when the
+        driver does not run in its own cgroup.
+        """
+        if self.cgroup is not None:
+            return self.cgroup.get_usage()
+
     def _exec(self, command, stdout=False, ignore_failure=False,
               stdin=None, wait_for_line=None, wait_for_port=None,
-              path=[], env=None,
+              wait_for_probe=None, path=[], env=None,
               forbidden_line_after_start=None,
-              allow_debug=True):
+              allow_debug=True, wait_timeout=None):
         LOG.debug("executing: %s", command)
 
         app = command[0]
 
         debug = allow_debug and LOG.isEnabledFor(logging.DEBUG)
 
-        if stdout or wait_for_line or debug:
+        # The output of a daemon is collected until it is ready, to report
+        # why it failed to start
+        collect = bool(stdout or wait_for_line or wait_for_port or
+                       wait_for_probe)
+        if collect or debug:
             stdout_fd = subprocess.PIPE
         else:
             stdout_fd = subprocess.DEVNULL
@@ -160,111 +728,182 @@ class Driver(fixtures.Fixture):
         else:
             stdin_fd = subprocess.DEVNULL
 
-        if path or env:
+        thread_environ = _get_thread_environ()
+        if path or env or thread_environ:
             complete_env = dict(os.environ)
+            if thread_environ:
+                complete_env.update(thread_environ)
             if env:
                 complete_env.update(env)
             if path:
                 complete_env.update({
-                    "PATH": ":".join(path) + ":" + os.getenv("PATH", ""),
+                    "PATH": ":".join(path) + ":" + complete_env.get("PATH",
+                                                                    ""),
                 })
         else:
             complete_env = None
 
-        try:
-            c = psutil.Popen(
-                command,
-                close_fds=True,
-                stdin=stdin_fd,
-                stdout=stdout_fd,
-                stderr=subprocess.STDOUT,
-                env=complete_env,
-                preexec_fn=os.setsid,
-            )
-        except OSError as e:
-            raise RuntimeError(
-                "Unable to run command `%s': %s" % (" ".join(command), e))
-
-        self.addCleanup(self._kill, c)
+        with tracing.span(app, "exec",
+                          command=" ".join(command)) as span_args:
+            try:
+                c = psutil.Popen(
+                    command,
+                    close_fds=True,
+                    stdin=stdin_fd,
+                    stdout=stdout_fd,
+                    stderr=subprocess.STDOUT,
+                    env=complete_env,
+                    preexec_fn=self._preexec,
+                )
+            except OSError as e:
+                raise RuntimeError(
+                    "Unable to run command `%s': %s" % (" ".join(command), e))
+
+            self._add_process(c)
+            span_args["pid"] = c.pid
+
+            if stdout_fd == subprocess.PIPE:
+                output = _Output(app, c.pid, wait_for_line, collect=collect)
+                _get_multiplexer().register(c.stdout, output)
+                # Store the output into the Process() to be able to release it
+                c._pifpaf_output = output
+            else:
+                c._pifpaf_output = None
 
-        if stdin:
-            LOG.debug("%s input: %s", app, stdin)
-            c.stdin.write(stdin)
-            c.stdin.close()
-
-        if stdout or wait_for_line:
-            lines = []
-            while True:
-                line = c.stdout.readline()
-                self._log_output(app, c.pid, line)
-                lines.append(line)
-                if not line:
-                    if wait_for_line:
-                        raise RuntimeError(
-                            "Program did not print: `%s'\nOutput: %s"
-                            % (wait_for_line, b"".join(lines)))
-                    break
-                decoded_line = os.fsdecode(line)
-
-                if wait_for_line and re.search(wait_for_line,
-                                               decoded_line):
-                    break
-            stdout_str = b"".join(lines)
-        else:
-            stdout_str = None
-
-        if (stdout or wait_for_line) and forbidden_line_after_start:
-            timeout, forbidden_output = forbidden_line_after_start
-            r, w, x = select.select([c.stdout.fileno()], [], [], timeout)
-            if r:
-                line = c.stdout.readline()
-                self._log_output(app, c.pid, line)
-                lines.append(line)
-                if c.poll() is not None:
-                    # Read the rest if the process is dead, this help debugging
-                    while line:
-                        line = c.stdout.readline()
-                        self._log_output(app, c.pid, line)
-                        lines.append(line)
-                if line and re.search(forbidden_output, os.fsdecode(line)):
+            if stdin:
+                LOG.debug("%s input: %s", app, stdin)
+                c.stdin.write(stdin)
+                c.stdin.close()
+
+            if wait_for_line:
+                with tracing.span(app, "wait_for_line", line=wait_for_line):
+                    matched = output.wait_for_match()
+                if not matched:
                     raise RuntimeError(
-                        "Program print a forbidden line: `%s'\nOutput: %s"
-                        % (forbidden_output, b"".join(lines)))
-
-        if stdout or wait_for_line or debug:
-            # Continue to read
-            t = threading.Thread(target=self._read_in_bg,
-                                 args=(app, c.pid, c.stdout,))
-            t.daemon = True
-            t.start()
-            # Store the thread ref into the Process() to be able
-            # to clean it
-            c._log_thread = t
-
-        if wait_for_port:
-            for i in range(0, 10):
-                with contextlib.closing(
-                        socket.socket(socket.AF_INET,
-                                      socket.SOCK_STREAM)) as sock:
-                    if sock.connect_ex(('127.0.0.1', wait_for_port)) == 0:
-                        break
-                time.sleep(1)
+                        "Program did not print: `%s'\nOutput: %s"
+                        % (wait_for_line, output.get_output()))
+                stdout_str = output.get_output(output.match)
+            elif stdout:
+                with tracing.span(app, "wait_for_eof"):
+                    output.wait_for_eof()
+                stdout_str = output.get_output()
             else:
-                raise RuntimeError("Program did not open port %s" %
-                                   wait_for_port)
+                stdout_str = None
+
+            if wait_for_line and forbidden_line_after_start:
+                timeout, forbidden_output = forbidden_line_after_start
+                line = output.wait_for_line_after_match(timeout)
+                if line is not None:
+                    if c.poll() is not None:
+                        # Read the rest if the process is dead, this help
+                        # debugging
+                        output.wait_for_eof(timeout)
+                    if re.search(forbidden_output, os.fsdecode(line)):
+                        raise RuntimeError(
+                            "Program print a forbidden line: `%s'\nOutput: %s"
+                            % (forbidden_output, output.get_output()))
+
+            if stdout_fd != subprocess.PIPE:
+                output = None
+
+            if wait_for_port:
+                def _port_is_ready():
+                    return util.is_port_listening(
+                        wait_for_port, self._get_process_tree(c))
+
+                self._wait_until_ready(c, _port_is_ready,
+                                       "opening port %s" % wait_for_port,
+                                       wait_timeout, output)
+
+            if wait_for_probe:
+                # A probe over TCP could be answered by another program that
+                # already listens on the port
+                if (isinstance(wait_for_probe, probes.TCPProbe) and
+                        wait_for_probe.path):
+                    probe_port = None
+                else:
+                    probe_port = getattr(wait_for_probe, "port", None)
+
+                def _probe_is_ready():
+                    if not wait_for_probe():
+                        return False
+                    if (probe_port is None or util.is_port_listening(
+                            probe_port, self._get_process_tree(c))):
+                        return True
+                    raise RuntimeError(
+                        "Port %d is already in use by another program"
+                        % probe_port)
+
+                self._wait_until_ready(c, _probe_is_ready,
+                                       "being ready for %s" % wait_for_probe,
+                                       wait_timeout, output)
+
+            if output is not None:
+                output.stop_collecting()
 
-        if not wait_for_line and not wait_for_port:
-            status = c.wait()
-            if not ignore_failure and status != 0:
-                raise RuntimeError("Error while running command: %s" % command)
+            if not wait_for_line and not wait_for_port and not wait_for_probe:
+                with tracing.span(app, "wait_for_exit"):
+                    status = c.wait()
+                if not ignore_failure and status != 0:
+                    raise RuntimeError("Error while running command: %s"
+                                       % command)
 
-        return c, stdout_str
+            return c, stdout_str
+
+    @staticmethod
+    def _get_process_tree(process):
+        """Return a process, its children and the rest of its group.
+
+        Daemons that detach from their parent usually stay in its group.
+        """
+        try:
+            procs = [process] + process.children(recursive=True)
+        except psutil.NoSuchProcess:
+            procs = []
+        pids = set(p.pid for p in procs)
+        procs.extend(p for p in util._get_procs_of_pgids(set([process.pid]))
+                     if p.pid not in pids)
+        return procs
+
+    def _wait_until_ready(self, process, check, what, timeout=None,
+                          output=None):
+        def _check():
+            # The program may exit after having spawned a daemon, only stop
+            # waiting if it failed. This is checked first, as another
+            # program may answer in place of the one that just failed.
+            if process.poll():
+                message = ("Program exited with status %d before %s"
+                           % (process.returncode, what))
+                if output is not None:
+                    # Whatever is left to read, if nothing else holds it
+                    output.wait_for_eof(1)
+                    if output.get_output():
+                        message += "\nOutput: %s" % os.fsdecode(
+                            output.get_output())
+                raise RuntimeError(message)
+            return check()
+
+        with tracing.span(process.args[0], "wait_until_ready", what=what):
+            ready = util.wait_for(_check, timeout or self.wait_timeout)
+        if not ready:
+            raise RuntimeError("Program timed out before %s" % what)
 
     def _touch(self, fname):
         open(fname, 'a').close()
         os.utime(fname, None)
 
+    @property
+    def template_env(self):
+        # Only a few drivers use templates, jinja2 is slow to import
+        if self._template_env is None:
+            import jinja2
+
+            self._template_env = jinja2.Environment(
+                loader=jinja2.PackageLoader('pifpaf', self.templatedir))
+        return self._template_env
+
     def template(self, resource, env, dest):
-        template = self.template_env.get_template(resource)
-        with open(dest, 'w') as f:
-            f.write(template.render(**env))
+        with tracing.span(resource, "template", dest=dest):
+            template = self.template_env.get_template(resource)
+            with open(dest, 'w') as f:
+                f.write(template.render(**env))
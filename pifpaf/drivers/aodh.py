@@ -14,6 +14,7 @@
 import os
 
 from pifpaf import drivers
+from pifpaf import probes
 from pifpaf.drivers import gnocchi
 from pifpaf.drivers import postgresql
 
@@ -66,15 +67,18 @@ class AodhDriver(drivers.Driver):
     def _setUp(self):
         super(AodhDriver, self)._setUp()
 
-        if self.database_url is None:
-            pg = self.useFixture(
-                postgresql.PostgreSQLDriver(port=self.database_port))
-            self.database_url = pg.url
-
-        g = self.useFixture(gnocchi.GnocchiDriver(
+        g = gnocchi.GnocchiDriver(
             port=self.gnocchi_port,
             indexer_port=self.gnocchi_indexer_port,
-        ))
+        )
+
+        # The database and Gnocchi are independent, start them together
+        if self.database_url is None:
+            pg = postgresql.PostgreSQLDriver(port=self.database_port)
+            self.useFixtures(pg, g)
+            self.database_url = pg.url
+        else:
+            self.useFixture(g)
 
         conffile = os.path.join(self.tempdir, "aodh.conf")
 
@@ -93,7 +97,7 @@ endpoint = %s""" % (self.database_url, g.http_url))
         c, _ = self._exec(["aodh-api", "--port", str(self.port),
                            "--",
                            "--config-file=%s" % conffile],
-                          wait_for_line="Available at http://")
+                          wait_for_probe=probes.HTTPProbe(self.port))
 
         c, _ = self._exec(["aodh-evaluator", "--config-file=%s" % conffile],
                           wait_for_line="initiating evaluation cycle")
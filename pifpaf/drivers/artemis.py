@@ -20,6 +20,7 @@ class ArtemisDriver(drivers.Driver):
     DEFAULT_PORT = 5673
     DEFAULT_USERNAME = "pifpaf"
     DEFAULT_PASSWORD = "secrete"
+    STORAGE_SIZE = 128 * 1024 * 1024
 
     def __init__(self, port=DEFAULT_PORT,
                  username=DEFAULT_USERNAME,
@@ -55,6 +56,19 @@ class ArtemisDriver(drivers.Driver):
              "help": "Disable anonymous users"},
         ]
 
+    @staticmethod
+    def _relocate(old, new, directories):
+        for directory in directories:
+            for root, dirs, files in os.walk(directory):
+                for name in files:
+                    path = os.path.join(root, name)
+                    with open(path, "rb") as f:
+                        content = f.read()
+                    if old.encode() in content:
+                        with open(path, "wb") as f:
+                            f.write(content.replace(old.encode(),
+                                                    new.encode()))
+
     def _setUp(self):
         super(ArtemisDriver, self)._setUp()
 
@@ -62,13 +76,26 @@ class ArtemisDriver(drivers.Driver):
         brokerbin = os.path.join(brokerdir, "bin")
         os.makedirs(brokerdir)
 
-        self._exec(["artemis", "create",
-                    "--user", self.username,
-                    "--password", self.password,
-                    self.login,
-                    brokerdir],
-                   path=self._path,
-                   wait_for_line='You can now start the broker by executing:')
+        origin = self._bootstrap_cached(
+            "artemis",
+            (self._executable_fingerprint("artemis", self._path),
+             self.username, self.password, self.login),
+            brokerdir,
+            # Wait for the command to exit, the broker instance is not
+            # complete when it prints how to start it
+            lambda: self._exec(
+                ["artemis", "create",
+                 "--user", self.username,
+                 "--password", self.password,
+                 self.login,
+                 brokerdir],
+                path=self._path))
+        if origin is not None:
+            # The broker instance scripts and configuration reference their
+            # own location
+            self._relocate(origin, brokerdir,
+                           [os.path.join(brokerdir, "bin"),
+                            os.path.join(brokerdir, "etc")])
 
         template_env = {
             "TMP_DIR": self.tempdir,
@@ -11,22 +11,163 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import functools
+import hashlib
+import json
+import logging
 import os
+import re
 import uuid
 
+import click
+
 import packaging.version
 
 from pifpaf import drivers
+from pifpaf import probes
+from pifpaf import util
+
+# NOTE(tobias-urdin): The rados python bindings is only installed
+# for the python version that the distro ships.
+try:
+    import rados
+except ImportError:
+    rados = None
+
+
+LOG = logging.getLogger(__name__)
+
+# How the interactive ceph client reports a failed command, e.g.
+# `Error: 22 EINVAL' or `Invalid command: ...'; its lines start with the
+# prompts printed while reading the commands
+_ERROR_RE = re.compile(r"^(?:ceph> )*(Error: \d+ E[A-Z]+|Invalid command)")
+
+
+class MonitorSession(object):
+    """Send commands to the Ceph monitors.
+
+    A single librados connection is used when the `rados` module is
+    available, otherwise each command runs the `ceph` client. Commands are
+    given as the JSON the monitors expect, e.g. {"prefix": "osd create"};
+    the arguments must be in the order the `ceph` client takes them.
+    """
+
+    def __init__(self, driver, conffile, timeout):
+        """Connect to the monitors."""
+        self.driver = driver
+        self.conffile = conffile
+        self._cluster = None
+        if rados is not None:
+            cluster = rados.Rados(conffile=conffile)
+            cluster.connect(timeout=timeout)
+            self._cluster = cluster
+
+    @staticmethod
+    def _to_args(command):
+        args = command["prefix"].split()
+        for key, value in command.items():
+            if key == "prefix":
+                continue
+            if key == "id" and args[0] == "osd":
+                # The monitors take the OSD id, the client its name
+                args.append("osd.%d" % value)
+            elif isinstance(value, (list, tuple)):
+                args.extend(str(v) for v in value)
+            else:
+                args.append(str(value))
+        return args
+
+    def command(self, command):
+        """Run a monitor command and return its decoded JSON output."""
+        if self._cluster is not None:
+            ret, out, err = self._cluster.mon_command(
+                json.dumps(dict(command, format="json")), b"")
+            if ret != 0:
+                raise RuntimeError("Ceph command `%s' failed: %s"
+                                   % (" ".join(self._to_args(command)), err))
+        else:
+            _, out = self.driver._exec(
+                ["ceph", "-c", self.conffile, "--format", "json"] +
+                self._to_args(command), stdout=True)
+        if out.strip():
+            return json.loads(out)
+
+    def run_batch(self, commands):
+        """Run several monitor commands.
+
+        With librados, the commands stop at the first failure. Otherwise,
+        they are all sent to a single `ceph` client, which runs all of them
+        even if some fail; the errors it reports are raised once it is done.
+        """
+        if self._cluster is not None:
+            for command in commands:
+                self.command(command)
+        elif commands:
+            _, out = self.driver._exec(
+                ["ceph", "-c", self.conffile],
+                stdin=b"".join(" ".join(self._to_args(command)).encode() +
+                               b"\n" for command in commands),
+                stdout=True)
+            # The interactive client prints the errors and exits with 0
+            out = os.fsdecode(out)
+            errors = [m.group(1) for m in map(_ERROR_RE.match,
+                                              out.splitlines()) if m]
+            if errors:
+                # The reason of the errors is printed on the other lines
+                raise RuntimeError("Ceph commands failed: %s\nOutput: %s"
+                                   % (", ".join(errors), out))
+
+    def get_status(self):
+        """Return the OSD map counters and the health of the cluster."""
+        status = self.command({"prefix": "status"})
+        # Before Nautilus, the counters are in `osdmap.osdmap`
+        osdmap = status.get("osdmap", {})
+        osdmap = osdmap.get("osdmap", osdmap)
+        # Before Luminous, the health is in `overall_status`
+        health = status.get("health", {})
+        return osdmap, health.get("status") or health.get("overall_status")
+
+    def close(self):
+        if self._cluster is not None:
+            self._cluster.shutdown()
+            self._cluster = None
 
 
 class CephDriver(drivers.Driver):
     DEFAULT_PORT = 6790
-
-    def __init__(self, port=DEFAULT_PORT,
-                 **kwargs):
+    DEFAULT_OSD_BACKEND = "default"
+    DEFAULT_RGW_PORT = 7480
+    RGW_USER = "pifpaf"
+    RGW_ACCESS_KEY_ID = "PIFPAFACCESSKEY"
+    RGW_SECRET_ACCESS_KEY = "pifpafsecretkey"
+    # Capacity reported by memstore, the data is only stored as needed
+    MEMSTORE_SIZE = 1024 * 1024 * 1024
+    STORAGE_SIZE = 1024 * 1024 * 1024
+    REQUIRES_XATTR = True
+
+    def __init__(self, port=DEFAULT_PORT, pools=(),
+                 osd_backend=DEFAULT_OSD_BACKEND, osds=1, pool_size=1,
+                 rgw=False, rgw_port=DEFAULT_RGW_PORT, **kwargs):
         """Create a new Ceph cluster."""
         super(CephDriver, self).__init__(**kwargs)
         self.port = port
+        self.rgw = rgw
+        self.rgw_port = rgw_port
+        self.pools = pools
+        if osds < 1:
+            raise ValueError("At least one OSD is needed")
+        if not 1 <= pool_size <= osds:
+            raise ValueError("Pool size must be between 1 and the number "
+                             "of OSDs")
+        self.osds = osds
+        self.pool_size = pool_size
+        self.STORAGE_SIZE = CephDriver.STORAGE_SIZE * osds
+        if osd_backend not in ("default", "memstore"):
+            raise ValueError("Unknown OSD backend `%s'" % osd_backend)
+        self.osd_backend = osd_backend
+        if osd_backend == "memstore":
+            # The OSD only writes its metadata on the filesystem
+            self.REQUIRES_XATTR = False
 
     @classmethod
     def get_options(cls):
@@ -35,19 +176,44 @@ class CephDriver(drivers.Driver):
              "type": int,
              "default": cls.DEFAULT_PORT,
              "help": "port to use for Ceph Monitor"},
+            {"param_decls": ["--pool", "pools"],
+             "multiple": True,
+             "help": "pool to create, can be repeated"},
+            {"param_decls": ["--osd-backend"],
+             "type": click.Choice(["default", "memstore"]),
+             "default": cls.DEFAULT_OSD_BACKEND,
+             "help": "object store of the OSD: `memstore` keeps the "
+             "objects in memory, `default` uses the default object store "
+             "of the Ceph version, on the disk"},
+            {"param_decls": ["--osds"],
+             "type": int,
+             "default": 1,
+             "help": "number of OSDs to start"},
+            {"param_decls": ["--pool-size"],
+             "type": int,
+             "default": 1,
+             "help": "default number of replicas of the pools, at most the "
+             "number of OSDs"},
+            {"param_decls": ["--rgw"],
+             "is_flag": True,
+             "help": "start a RADOS Gateway with an S3 user"},
+            {"param_decls": ["--rgw-port"],
+             "type": int,
+             "default": cls.DEFAULT_RGW_PORT,
+             "help": "port to use for the RADOS Gateway"},
         ]
 
     def _setUp(self):
         super(CephDriver, self)._setUp()
 
-        self._ensure_xattr_support()
+        if self.REQUIRES_XATTR:
+            self._ensure_xattr_support()
 
-        fsid = str(uuid.uuid4())
         conffile = os.path.join(self.tempdir, "ceph.conf")
         mondir = os.path.join(self.tempdir, "mon", "ceph-a")
-        osddir = os.path.join(self.tempdir, "osd", "ceph-0")
         os.makedirs(mondir)
-        os.makedirs(osddir)
+        for osd_id in range(self.osds):
+            os.makedirs(os.path.join(self.tempdir, "osd", "ceph-%d" % osd_id))
 
         _, version = self._exec(["ceph", "--version"], stdout=True)
         version = version.decode("ascii").split()[2]
@@ -77,14 +243,39 @@ mon_host = v2:127.0.0.1:%(port)d/0
         else:
             msgrv2_extra = ""
 
-        # FIXME(sileht): check availible space on /dev/shm
-        # if os.path.exists("/dev/shm") and os.access('/dev/shm', os.W_OK):
-        #     journal_path = "/dev/shm/$cluster-$id-journal"
-        # else:
+        if self.rgw:
+            # The gateway creates a few pools, the default number of
+            # placement groups would be slow to create on a test cluster
+            extra += """
+osd pool default pg num = 8
+osd pool default pgp num = 8
+"""
+            if version >= packaging.version.Version("13.0.0"):
+                frontend = "beast port=%d" % self.rgw_port
+            else:
+                frontend = "civetweb port=%d" % self.rgw_port
+            rgw = """
+[client.rgw.pifpaf]
+rgw frontends = %s
+rgw data = %s/rgw
+""" % (frontend, self.tempdir)
+            os.makedirs(os.path.join(self.tempdir, "rgw"))
+        else:
+            rgw = ""
+
+        if self.osd_backend == "memstore":
+            objectstore = """
+osd objectstore = memstore
+memstore device bytes = %d
+""" % self.MEMSTORE_SIZE
+        else:
+            objectstore = ""
+
+        # NOTE: with the memory storage, the journal is on /dev/shm along
+        # with the rest of the data, once its free space has been checked
         journal_path = "%s/osd/$cluster-$id/journal" % self.tempdir
 
-        with open(conffile, "w") as f:
-            f.write("""[global]
+        conf = """[global]
 fsid = %(fsid)s
 %(msgrv2_extra)s
 
@@ -93,8 +284,8 @@ auth cluster required = none
 auth service required = none
 auth client required = none
 
-## no replica
-osd pool default size = 1
+## replicas on any OSD, they all run on this host
+osd pool default size = %(pool_size)d
 osd pool default min size = 1
 osd crush chooseleaf type = 0
 
@@ -123,7 +314,7 @@ filestore min sync interval = 10000
 mon_warn_on_pool_no_redundancy = false
 
 %(extra)s
-
+%(objectstore)s
 journal_aio = false
 journal_dio = false
 journal zero on create = false
@@ -143,18 +334,34 @@ auth allow insecure global id reclaim = false
 [mon.a]
 host = localhost
 mon addr = 127.0.0.1:%(port)d
-""" % dict(fsid=fsid, msgrv2_extra=msgrv2_extra, tempdir=self.tempdir,
-           port=self.port, journal_path=journal_path, extra=extra))  # noqa
+%(rgw)s""" % dict(fsid="@FSID@", msgrv2_extra=msgrv2_extra, tempdir=self.tempdir,  # noqa
+           port=self.port, journal_path=journal_path, extra=extra,  # noqa
+           objectstore=objectstore, pool_size=self.pool_size,  # noqa
+           rgw=rgw)  # noqa
+
+        # The monitor store is created from the configuration and embeds the
+        # fsid, so a cached monitor can only be reused with the same ones.
+        # The data directory changes on every run, it does not count.
+        mon_key = (self._executable_fingerprint("ceph-mon"), self.port,
+                   str(version),
+                   hashlib.sha1(conf.replace(self.tempdir, "@TEMPDIR@")
+                                .encode()).hexdigest())
+        if self.cache_dir:
+            fsid = str(uuid.uuid5(uuid.NAMESPACE_OID, repr(mon_key)))
+        else:
+            fsid = str(uuid.uuid4())
+        with open(conffile, "w") as f:
+            f.write(conf.replace("@FSID@", fsid))
 
-        ceph_opts = ["ceph", "-c", conffile]
         mon_opts = ["ceph-mon", "-c", conffile, "--id", "a", "-d"]
         mgr_opts = ["ceph-mgr", "-c", conffile, "-d"]
-        osd_opts = ["ceph-osd", "-c", conffile, "--id", "0", "-d",
-                    "-m", "127.0.0.1:%d" % self.port]
 
         # Create and start monitor
-        self._exec(mon_opts + ["--mkfs"])
-        self._touch(os.path.join(mondir, "done"))
+        def mon_mkfs():
+            self._exec(mon_opts + ["--mkfs"])
+            self._touch(os.path.join(mondir, "done"))
+
+        self._bootstrap_cached("ceph-mon", mon_key, mondir, mon_mkfs)
         mon, _ = self._exec(
             mon_opts,
             wait_for_line=r"mon.a@0\(leader\).mds e1 print_map")
@@ -165,29 +372,100 @@ mon addr = 127.0.0.1:%(port)d
                 mgr_opts,
                 wait_for_line="(mgr send_beacon active|waiting for OSDs)")
 
-        # Create and start OSD
-        self._exec(ceph_opts + ["osd", "create"])
-        self._exec(ceph_opts + ["osd", "crush", "add", "osd.0", "1",
-                                "root=default"])
-        self._exec(osd_opts + ["--mkfs", "--mkjournal"])
+        # The session is closed before leaving setUp, as the librados
+        # threads would not survive pifpaf daemonizing itself.
+        session = MonitorSession(self, conffile, self.wait_timeout)
+        try:
+            self._setup_cluster(session, version, conffile)
+        finally:
+            session.close()
+
+        self.putenv("CEPH_CONF", conffile, True)
+        self.putenv("CEPH_CONF", conffile)
+        self.putenv("URL", "ceph://localhost:%d" % self.port)
+
+        if self.rgw:
+            self._start_rgw(conffile)
+
+    def _start_rgw(self, conffile):
+        self._exec(["radosgw", "-c", conffile, "-n", "client.rgw.pifpaf",
+                    "-d"],
+                   wait_for_probe=probes.HTTPProbe(self.rgw_port))
+        self._exec(["radosgw-admin", "-c", conffile, "user", "create",
+                    "--uid", self.RGW_USER, "--display-name", self.RGW_USER,
+                    "--access-key", self.RGW_ACCESS_KEY_ID,
+                    "--secret", self.RGW_SECRET_ACCESS_KEY])
+
+        self.putenv("RGW_PORT", str(self.rgw_port))
+        self.putenv("RGW_ACCESS_KEY_ID", self.RGW_ACCESS_KEY_ID)
+        self.putenv("RGW_SECRET_ACCESS_KEY", self.RGW_SECRET_ACCESS_KEY)
+        self.putenv("RGW_HTTP_URL", "http://localhost:%d" % self.rgw_port)
+        self.putenv("RGW_URL", "s3://%s:%s@localhost:%d" % (
+            self.RGW_ACCESS_KEY_ID, self.RGW_SECRET_ACCESS_KEY,
+            self.rgw_port))
+
+    def _get_setup_commands(self, version):
+        commands = []
+        for osd_id in range(self.osds):
+            commands.append({"prefix": "osd create"})
+            commands.append({"prefix": "osd crush add", "id": osd_id,
+                             "weight": 1.0, "args": ["root=default"]})
+        if version >= packaging.version.Version("12.0.0"):
+            for ratio in ("full", "backfillfull", "nearfull"):
+                commands.append({"prefix": "osd set-%s-ratio" % ratio,
+                                 "ratio": 0.95})
+        for pool in self.pools:
+            commands.append({"prefix": "osd pool create", "pool": pool,
+                             "pg_num": 8})
+            if version >= packaging.version.Version("12.0.0"):
+                # Otherwise the cluster warns about it
+                commands.append({"prefix": "osd pool application enable",
+                                 "pool": pool, "app": "pifpaf"})
+        return commands
+
+    def _setup_cluster(self, session, version, conffile):
+        # Register the OSDs and configure the cluster at once, a ceph client
+        # takes about a second to start and connect
+        session.run_batch(self._get_setup_commands(version))
+
+        # Create and start the OSDs, they do not depend on each other
+        osd_opts = [["ceph-osd", "-c", conffile, "--id", str(osd_id), "-d",
+                     "-m", "127.0.0.1:%d" % self.port]
+                    for osd_id in range(self.osds)]
+        if self.osd_backend == "memstore":
+            mkfs_opts = ["--mkfs"]
+        else:
+            mkfs_opts = ["--mkfs", "--mkjournal"]
+        self._concurrently(*[functools.partial(self._exec, opts + mkfs_opts)
+                             for opts in osd_opts])
         if version < packaging.version.Version("0.94.0"):
             wait_for_line = "journal close"
         else:
             wait_for_line = "done with init"
-        osd, _ = self._exec(osd_opts, wait_for_line=wait_for_line)
-
-        if version >= packaging.version.Version("12.0.0"):
-            self._exec(ceph_opts + ["osd", "set-full-ratio", "0.95"])
-            self._exec(ceph_opts + ["osd", "set-backfillfull-ratio", "0.95"])
-            self._exec(ceph_opts + ["osd", "set-nearfull-ratio", "0.95"])
+        with self._stop_together():
+            self._concurrently(*[functools.partial(self._exec, opts,
+                                                   wait_for_line=wait_for_line)
+                                 for opts in osd_opts])
 
         # Wait it's ready
-        out = b""
-        while b"HEALTH_OK" not in out:
-            ceph, out = self._exec(ceph_opts + ["health"], stdout=True)
-            if b"HEALTH_ERR" in out:
+        self._wait_for_health(session)
+
+    def _wait_for_health(self, session):
+        def _is_healthy():
+            # A single command, each one runs a ceph client without librados
+            stat, status = session.get_status()
+            LOG.debug("Ceph OSDs up: %s, in: %s, health: %s",
+                      stat.get("num_up_osds"), stat.get("num_in_osds"),
+                      status)
+            if (stat.get("num_up_osds") != self.osds or
+               stat.get("num_in_osds") != self.osds):
+                return False
+            if status == "HEALTH_ERR":
                 raise RuntimeError("Fail to deploy ceph")
+            return status == "HEALTH_OK"
 
-        self.putenv("CEPH_CONF", conffile, True)
-        self.putenv("CEPH_CONF", conffile)
-        self.putenv("URL", "ceph://localhost:%d" % self.port)
+        # The cluster takes seconds to converge, no need to ask it often
+        if not util.wait_for(_is_healthy, self.wait_timeout,
+                             interval=0.1, max_interval=2):
+            raise RuntimeError("Ceph is not healthy after %d seconds"
+                               % self.wait_timeout)
@@ -12,6 +12,7 @@
 # limitations under the License.
 
 from pifpaf import drivers
+from pifpaf import probes
 
 
 class ConsulDriver(drivers.Driver):
@@ -34,6 +35,10 @@ class ConsulDriver(drivers.Driver):
              "help": "port to use for consul"}
         ]
 
+    @staticmethod
+    def _has_leader(status, body):
+        return status == 200 and body.strip() not in (b"", b'""')
+
     def _setUp(self):
         super(ConsulDriver, self)._setUp()
         c, _ = self._exec(["consul", "agent", "-server",
@@ -42,7 +47,9 @@ class ConsulDriver(drivers.Driver):
                            "-node=%s" % self.DEFAULT_NODE,
                            "-bind=%s" % self.DEFAULT_HOST,
                            "-http-port=%s" % self.port],
-                          wait_for_line="New leader elected")
+                          wait_for_probe=probes.HTTPProbe(
+                              self.port, self.DEFAULT_HOST,
+                              "/v1/status/leader", self._has_leader))
 
         self.putenv("CONSUL_PORT", str(self.port))
         self.putenv("URL", "consul://%s:%d" % (self.DEFAULT_HOST, self.port))
@@ -14,6 +14,7 @@
 import os
 
 from pifpaf import drivers
+from pifpaf import probes
 
 
 class CouchDBDriver(drivers.Driver):
@@ -71,8 +72,9 @@ port = %d""" % (self.tempdir, self.tempdir, self.tempdir,
         c, _ = self._exec(["couchdb", "-n"] +
                           cmdline_cfgfiles +
                           ["-a", cfgfile],
-                          wait_for_line="Apache CouchDB has started."
-                                        " Time to relax.")
+                          wait_for_probe=probes.HTTPProbe(
+                              self.port, "127.0.0.1",
+                              validate=lambda status, body: status == 200))
 
         self.putenv("COUCHDB_PORT", str(self.port))
         self.putenv("URL", "couchdb://localhost:%d" % self.port)
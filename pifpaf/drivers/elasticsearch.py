@@ -14,10 +14,12 @@
 import os
 
 from pifpaf import drivers
+from pifpaf import probes
 
 
 class ElasticsearchDriver(drivers.Driver):
     DEFAULT_PORT = 9200
+    STORAGE_SIZE = 256 * 1024 * 1024
 
     def __init__(self, port=DEFAULT_PORT, **kwargs):
         """Create a new ElasticSearch server."""
@@ -44,7 +46,8 @@ class ElasticsearchDriver(drivers.Driver):
                 "-Epath.data=" + self.tempdir
             ],
             path=["/usr/share/elasticsearch/bin"],
-            wait_for_line=" started")
+            wait_for_probe=probes.HTTPProbe(
+                self.port, validate=lambda status, body: status == 200))
 
         self.putenv("ELASTICSEARCH_PORT", str(self.port))
         self.putenv("URL", "es://localhost:%d" % self.port)
@@ -21,6 +21,7 @@ class EtcdDriver(drivers.Driver):
     DEFAULT_PORT = 2379
     DEFAULT_PEER_PORT = 2380
     DEFAULT_CLUSTER = False
+    STORAGE_SIZE = 256 * 1024 * 1024
 
     def __init__(self, port=DEFAULT_PORT,
                  peer_port=DEFAULT_PEER_PORT,
@@ -52,9 +53,18 @@ class EtcdDriver(drivers.Driver):
     def _setUp(self):
         super(EtcdDriver, self)._setUp()
         if self.cluster:
-            http_urls = [("http://localhost:%d" % (p + 1),
-                          "http://localhost:%d" % p)
+            if "port" in self._allocated_ports:
+                ports = [(self.port, self._allocate_port())] + [
+                    (self._allocate_port(), self._allocate_port())
+                    for _ in range(2)]
+            else:
+                ports = [(p, p + 1)
                          for p in (self.port, self.port + 2, self.port + 4)]
+            # The peer port exported is the one of the first node
+            self.peer_port = ports[0][1]
+            http_urls = [("http://localhost:%d" % peer_port,
+                          "http://localhost:%d" % client_port)
+                         for client_port, peer_port in ports]
             execs = []
             for i, (peer_url, client_url) in enumerate(http_urls):
                 tempdir = os.path.join(self.tempdir, str(i))
@@ -67,7 +77,8 @@ class EtcdDriver(drivers.Driver):
                     "--advertise-client-urls", client_url,
                     "--listen-peer-urls", peer_url,
                     "--initial-advertise-peer-urls", peer_url,
-                    "--initial-cluster-token", "etcd-cluster-pifpaf",
+                    "--initial-cluster-token",
+                    "etcd-cluster-pifpaf-%d" % self.port,
                     "--initial-cluster", ",".join("pifpaf%d=%s" % (i, peer_url)
                                                   for i, (peer_url, client_url)
                                                   in enumerate(http_urls)),
@@ -75,10 +86,13 @@ class EtcdDriver(drivers.Driver):
                 ],), kwargs={
                     "wait_for_line": "ready to serve client requests"
                 })
-                t.start()
                 execs.append(t)
-            for t in execs:
-                t.join()
+            # The nodes of the cluster are stopped together
+            with self._stop_together():
+                for t in execs:
+                    t.start()
+                for t in execs:
+                    t.join()
             endpoints = ",".join(client_url
                                  for peer_url, client_url in http_urls)
         else:
@@ -19,6 +19,7 @@ import uuid
 import click
 
 from pifpaf import drivers
+from pifpaf import probes
 from pifpaf.drivers import postgresql
 from pifpaf.drivers import redis
 
@@ -90,9 +91,18 @@ class GnocchiDriver(drivers.Driver):
         except RuntimeError:
             pass
 
+        # PostgreSQL and Redis are independent, start them together
+        pg = r = None
+        subdrivers = []
         if self.indexer_url is None:
-            pg = self.useFixture(
-                postgresql.PostgreSQLDriver(port=self.indexer_port))
+            pg = postgresql.PostgreSQLDriver(port=self.indexer_port)
+            subdrivers.append(pg)
+        if self.coordination_driver == "redis":
+            r = redis.RedisDriver(port=self.coordination_port)
+            subdrivers.append(r)
+        self.useFixtures(*subdrivers)
+
+        if pg is not None:
             self.indexer_url = pg.url
 
         if self.storage_url is None:
@@ -146,8 +156,7 @@ class GnocchiDriver(drivers.Driver):
             raise RuntimeError("Storage driver %s is not supported" %
                                storage_driver)
 
-        if self.coordination_driver == "redis":
-            r = self.useFixture(redis.RedisDriver(port=self.coordination_port))
+        if r is not None:
             storage_config["coordination_url"] = r.url
 
         storage_config_string = "\n".join(
@@ -193,8 +202,7 @@ url = %s""" % (self.debug,
 
         args = ["gnocchi-api", "--config-file=%s" % conffile]
         c, _ = self._exec(args,
-                          wait_for_line=r"WSGI app 0 \(mountpoint=''\) ready")
-        self.addCleanup(self._kill, c)
+                          wait_for_probe=probes.HTTPProbe(self.port))
 
         self.http_url = "http://localhost:%d" % self.port
 
@@ -20,6 +20,7 @@ class InfluxDBDriver(drivers.Driver):
 
     DEFAULT_PORT = 51234
     DEFAULT_DATABASE = "test"
+    STORAGE_SIZE = 128 * 1024 * 1024
 
     def __init__(self, port=DEFAULT_PORT,
                  database=DEFAULT_DATABASE,
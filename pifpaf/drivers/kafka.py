@@ -21,6 +21,7 @@ class KafkaDriver(drivers.Driver):
     DEFAULT_ZOOKEEPER_PORT = 2181
     DEFAULT_PATH = ["/opt/kafka/bin",
                     "/usr/local/opt/kafka/bin"]
+    STORAGE_SIZE = 256 * 1024 * 1024
 
     def __init__(self, port=DEFAULT_KAFKA_PORT,
                  zookeeper_port=DEFAULT_ZOOKEEPER_PORT,
@@ -30,6 +31,19 @@ class KafkaDriver(drivers.Driver):
         self.port = port
         self.zookeeper_port = zookeeper_port
 
+    @classmethod
+    def get_options(cls):
+        return [
+            {"param_decls": ["--port"],
+             "type": int,
+             "default": cls.DEFAULT_KAFKA_PORT,
+             "help": "port to use for Kafka"},
+            {"param_decls": ["--zookeeper-port"],
+             "type": int,
+             "default": cls.DEFAULT_ZOOKEEPER_PORT,
+             "help": "port to use for ZooKeeper"},
+        ]
+
     def _setUp(self):
         super(KafkaDriver, self)._setUp()
 
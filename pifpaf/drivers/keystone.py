@@ -16,6 +16,7 @@ import shutil
 import uuid
 
 from pifpaf import drivers
+from pifpaf import probes
 
 
 class KeystoneDriver(drivers.Driver):
@@ -83,14 +84,14 @@ connection = sqlite:///%s/sqlite.db
              "--port", str(self.port),
              "--",
              "--config-file", conffile],
-            wait_for_line="Available at http://")
+            wait_for_probe=probes.HTTPProbe(self.port))
 
         c, _ = self._exec(
             ["keystone-wsgi-admin",
              "--port", str(self.admin_port),
              "--",
              "--config-file", conffile],
-            wait_for_line="Available at http://")
+            wait_for_probe=probes.HTTPProbe(self.admin_port))
 
         self.putenv("OS_AUTH_URL", self.http_url, True)
         self.putenv("OS_PROJECT_NAME", "admin", True)
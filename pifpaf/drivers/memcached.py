@@ -12,6 +12,7 @@
 # limitations under the License.
 
 from pifpaf import drivers
+from pifpaf import probes
 
 
 class MemcachedDriver(drivers.Driver):
@@ -58,8 +59,10 @@ class MemcachedDriver(drivers.Driver):
                 command.extend(["-o", "ssl_ca_cert=" + self.ssl_ca_cert])
 
             self.putenv("MEMCACHED_TLS_ENABLED", "1")
-
-        c, _ = self._exec(command, wait_for_port=self.port)
+            c, _ = self._exec(command, wait_for_port=self.port)
+        else:
+            c, _ = self._exec(
+                command, wait_for_probe=probes.MemcachedProbe(self.port))
 
         self.putenv("MEMCACHED_PORT", str(self.port))
         self.putenv("URL", "memcached://localhost:%d" % self.port)
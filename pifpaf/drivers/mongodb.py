@@ -17,6 +17,7 @@ from pifpaf import drivers
 class MongoDBDriver(drivers.Driver):
 
     DEFAULT_PORT = 29000
+    STORAGE_SIZE = 256 * 1024 * 1024
 
     def __init__(self, port=DEFAULT_PORT, **kwargs):
         """Create a new MongoDB server."""
@@ -10,9 +10,17 @@
 # implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
+import concurrent.futures
 import getpass
 import logging
 import os
+import queue
+import re
+import subprocess
+import threading
+import uuid
+
+import fixtures
 
 from pifpaf import drivers
 
@@ -20,6 +28,16 @@ LOG = logging.getLogger(__name__)
 
 
 class MySQLDriver(drivers.Driver):
+    STORAGE_SIZE = 512 * 1024 * 1024
+
+    def __init__(self, **kwargs):
+        """Create a new MySQL instance."""
+        super(MySQLDriver, self).__init__(**kwargs)
+        # Template name -> statements copying it into the current database
+        self._templates = {}
+        self._drop_lock = threading.Lock()
+        self._drop_executor = None
+
     def _setUp(self):
         super(MySQLDriver, self)._setUp()
         self.socket = os.path.join(self.tempdir, "mysql.socket")
@@ -30,20 +48,28 @@ class MySQLDriver(drivers.Driver):
 
         mysql_user_to_use = getpass.getuser()
 
-        c, _ = self._exec(["mysqld",
-                           "--no-defaults",
-                           "--tmpdir=" + tempdir,
-                           "--initialize-insecure",
-                           "--datadir=" + datadir,
-                           "--user=%s" % mysql_user_to_use],
-                          ignore_failure=True,
-                          path=["/usr/libexec"])
-        if c.returncode != 0:
-            # Use the old deprecated way
-            c, _ = self._exec(["mysql_install_db",
+        def bootstrap():
+            c, _ = self._exec(["mysqld",
                                "--no-defaults",
                                "--tmpdir=" + tempdir,
-                               "--datadir=" + datadir])
+                               "--initialize-insecure",
+                               "--datadir=" + datadir,
+                               "--user=%s" % mysql_user_to_use],
+                              ignore_failure=True,
+                              path=["/usr/libexec"])
+            if c.returncode != 0:
+                # Use the old deprecated way
+                c, _ = self._exec(["mysql_install_db",
+                                   "--no-defaults",
+                                   "--tmpdir=" + tempdir,
+                                   "--datadir=" + datadir])
+
+        self._bootstrap_cached(
+            "mysql",
+            (self._executable_fingerprint("mysqld", ["/usr/libexec"]),
+             mysql_user_to_use),
+            datadir, bootstrap)
+
         c, _ = self._exec(["mysqld",
                            "--no-defaults",
                            "--tmpdir=" + tempdir,
@@ -59,5 +85,253 @@ class MySQLDriver(drivers.Driver):
                     "-S", self.socket,
                     "-e", "CREATE DATABASE pifpaf;"])
         self.putenv("MYSQL_SOCKET", self.socket)
-        self.url = "mysql://root@localhost/pifpaf?unix_socket=" + self.socket
+        self.url = self.get_url()
         self.putenv("URL", self.url)
+
+    def get_url(self, database="pifpaf"):
+        return "mysql://root@localhost/%s?unix_socket=%s" % (
+            database, self.socket)
+
+    @staticmethod
+    def _quote(name):
+        if not re.match(r"^[a-zA-Z_][a-zA-Z0-9_]*$", name):
+            raise ValueError("Invalid identifier `%s'" % name)
+        return "`%s`" % name
+
+    def mysql(self, sql=None, database=None, sql_file=None, raw=False):
+        """Run SQL statements or a SQL file with mysql, return its output.
+
+        The rows are printed tab-separated, without headers.
+        """
+        if sql_file is not None:
+            with open(sql_file, "rb") as f:
+                sql = f.read()
+        elif isinstance(sql, str):
+            sql = sql.encode()
+        # Not using _exec as this runs for every test: there is no need to
+        # track these short-lived processes until cleanup
+        command = ["mysql", "--no-defaults", "-S", self.socket, "-N", "-B"]
+        if raw:
+            command.append("--raw")
+        if database is not None:
+            command.append(database)
+        LOG.debug("executing: %s", command)
+        p = subprocess.run(command, input=sql, stdout=subprocess.PIPE,
+                           stderr=subprocess.STDOUT)
+        if p.returncode != 0:
+            raise RuntimeError("mysql failed with status %d: %s"
+                               % (p.returncode, p.stdout.decode()))
+        return p.stdout
+
+    def _query(self, sql, database=None):
+        """Return the rows of a query, as lists of strings."""
+        return [line.split("\t")
+                for line in self.mysql(sql, database).decode().splitlines()]
+
+    def create_template(self, name="pifpaf_template", sql=None,
+                        sql_file=None):
+        """Create a golden database to copy with `create_database`.
+
+        `sql` and `sql_file` are run in the new database to create the
+        schema and seed it. The template must not be modified afterward.
+        Its tables, views and triggers are copied; stored routines and
+        events are not supported.
+        """
+        self.mysql("CREATE DATABASE %s" % self._quote(name))
+        if sql is not None or sql_file is not None:
+            self.mysql(sql, database=name, sql_file=sql_file)
+
+        unsupported = self._query(
+            "SELECT routine_name FROM information_schema.routines "
+            "WHERE routine_schema = '%s' "
+            "UNION SELECT event_name FROM information_schema.events "
+            "WHERE event_schema = '%s'" % (name, name))
+        if unsupported:
+            raise RuntimeError(
+                "Stored routines and events cannot be copied from a "
+                "template: %s" % ", ".join(row[0] for row in unsupported))
+
+        # The definitions of views and triggers reference the tables with
+        # the name of the template, they are created in the copies without
+        qualifier = "%s." % self._quote(name)
+
+        # Generated columns cannot be inserted into
+        columns = {}
+        for table, column in self._query(
+                "SELECT table_name, column_name "
+                "FROM information_schema.columns "
+                "WHERE table_schema = '%s' AND (generation_expression IS NULL "
+                "OR generation_expression = '') "
+                "ORDER BY table_name, ordinal_position" % name):
+            columns.setdefault(table, []).append(self._quote(column))
+
+        script = []
+        for table in self.mysql(
+                "SELECT table_name FROM information_schema.tables "
+                "WHERE table_schema = '%s' AND table_type = 'BASE TABLE'"
+                % name).decode().split():
+            out = self.mysql("SHOW CREATE TABLE %s" % self._quote(table),
+                             database=name, raw=True).decode()
+            script.append(out.split("\t", 1)[1] + ";")
+            script.append("INSERT INTO %s (%s) SELECT %s FROM %s.%s;" % (
+                self._quote(table), ", ".join(columns[table]),
+                ", ".join(columns[table]), self._quote(name),
+                self._quote(table)))
+
+        views = {}
+        for view, security, check, definition in self._query(
+                "SELECT table_name, security_type, check_option, "
+                "HEX(view_definition) FROM information_schema.views "
+                "WHERE table_schema = '%s'" % name):
+            definition = bytes.fromhex(definition).decode()
+            create = "CREATE SQL SECURITY %s VIEW %s AS %s" % (
+                security, self._quote(view),
+                definition.replace(qualifier, ""))
+            if check != "NONE":
+                create += " WITH %s CHECK OPTION" % check
+            views[view] = (create + ";", definition)
+        # Views using other views are created after them
+        while views:
+            for view, (create, definition) in sorted(views.items()):
+                if not any("%s%s" % (qualifier, self._quote(other))
+                           in definition
+                           for other in views if other != view):
+                    script.append(create)
+                    del views[view]
+                    break
+            else:
+                raise RuntimeError("Unable to order the views of %s: %s"
+                                   % (name, ", ".join(sorted(views))))
+
+        # Triggers are created once the content is copied, so the copy does
+        # not fire them
+        triggers = self._query(
+            "SELECT trigger_name, action_timing, event_manipulation, "
+            "event_object_table, action_orientation, HEX(action_statement) "
+            "FROM information_schema.triggers WHERE trigger_schema = '%s' "
+            "ORDER BY event_object_table, action_timing, event_manipulation, "
+            "action_order" % name)
+        if triggers:
+            script.append("DELIMITER $$")
+            for trigger, timing, event, table, orientation, body in triggers:
+                script.append("CREATE TRIGGER %s %s %s ON %s FOR EACH %s %s$$"
+                              % (self._quote(trigger), timing, event,
+                                 self._quote(table), orientation,
+                                 bytes.fromhex(body).decode().replace(
+                                     qualifier, "")))
+            script.append("DELIMITER ;")
+
+        self._templates[name] = script
+        return name
+
+    def create_database(self, template="pifpaf_template", name=None):
+        """Create a new database, as a copy of `template`.
+
+        The tables and their content, the views and the triggers are copied
+        in bulk with a single mysql command. Return the name of the
+        database.
+        """
+        if name is None:
+            name = "%s_%s" % (template, uuid.uuid4().hex[:12])
+        script = [
+            "CREATE DATABASE %s;" % self._quote(name),
+            "USE %s;" % self._quote(name),
+            "SET FOREIGN_KEY_CHECKS = 0;",
+        ] + self._templates[template]
+        self.mysql("\n".join(script))
+        return name
+
+    def _drop_database(self, name):
+        try:
+            self.mysql("DROP DATABASE IF EXISTS %s" % self._quote(name))
+        except RuntimeError as e:
+            LOG.warning("Unable to drop database %s: %s", name, e)
+
+    def drop_database(self, name, wait=False):
+        """Drop a database, in the background unless `wait` is True."""
+        if wait:
+            self._drop_database(name)
+            return
+        with self._drop_lock:
+            if self._drop_executor is None:
+                self._drop_executor = concurrent.futures.ThreadPoolExecutor(
+                    max_workers=1)
+                # Registered after mysqld is started, so it runs before it
+                # is stopped
+                self.addCleanup(self._drop_executor.shutdown, wait=True)
+        self._drop_executor.submit(self._drop_database, name)
+
+
+class MySQLDatabasePool(fixtures.Fixture):
+    """Keep copies of a template database of a `MySQLDriver` ready.
+
+    A background thread creates databases from the template so that `size`
+    of them are always ready to be handed out by `get`.
+    """
+
+    def __init__(self, driver, template="pifpaf_template", size=4):
+        """Create a new pool of databases."""
+        super(MySQLDatabasePool, self).__init__()
+        self.driver = driver
+        self.template = template
+        self.size = size
+
+    def _setUp(self):
+        self._ready = queue.Queue(maxsize=self.size)
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._fill, daemon=True)
+        self._thread.start()
+        self.addCleanup(self._cleanup)
+
+    def _fill(self):
+        while not self._stop.is_set():
+            try:
+                name = self.driver.create_database(self.template)
+            except Exception:  # noqa: B902
+                LOG.error("Unable to fill the pool of %s databases, "
+                          "stopping", self.template, exc_info=True)
+                return
+            while True:
+                try:
+                    self._ready.put(name, timeout=0.1)
+                except queue.Full:
+                    if self._stop.is_set():
+                        self.driver.drop_database(name)
+                        return
+                else:
+                    break
+
+    def _cleanup(self):
+        self._stop.set()
+        self._thread.join()
+        while True:
+            try:
+                self.driver.drop_database(self._ready.get_nowait())
+            except queue.Empty:
+                break
+
+    def get(self):
+        """Return the name of a new database copied from the template."""
+        try:
+            return self._ready.get_nowait()
+        except queue.Empty:
+            # The pool does not keep up, do not wait for it
+            return self.driver.create_database(self.template)
+
+    def release(self, name):
+        """Drop a database returned by `get`, in the background."""
+        self.driver.drop_database(name)
+
+
+class MySQLDatabase(fixtures.Fixture):
+    """A database taken from a `MySQLDatabasePool`, dropped on cleanup."""
+
+    def __init__(self, pool):
+        """Create a new database from a pool."""
+        super(MySQLDatabase, self).__init__()
+        self.pool = pool
+
+    def _setUp(self):
+        self.name = self.pool.get()
+        self.addCleanup(self.pool.release, self.name)
+        self.url = self.pool.driver.get_url(self.name)
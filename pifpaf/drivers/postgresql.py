@@ -11,9 +11,24 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import concurrent.futures
+import getpass
+import logging
 import os
+import re
+import subprocess
+import threading
+import uuid
+
+import fixtures
 
 from pifpaf import drivers
+from pifpaf import probes
+
+LOG = logging.getLogger(__name__)
+
+# Errors sent to the clients, such as the probe, while the server starts
+_STARTING_ERROR_RE = re.compile(r"FATAL:\s+the database system is ")
 
 
 class PostgreSQLDriver(drivers.Driver):
@@ -21,6 +36,7 @@ class PostgreSQLDriver(drivers.Driver):
     DEFAULT_PORT = 9824
     DEFAULT_HOST = ""
     DEFAULT_SYNC = False
+    STORAGE_SIZE = 128 * 1024 * 1024
 
     @classmethod
     def get_options(cls):
@@ -44,6 +60,8 @@ class PostgreSQLDriver(drivers.Driver):
         self.port = port
         self.host = host
         self.sync = sync
+        self._drop_lock = threading.Lock()
+        self._drop_executor = None
 
     def _setUp(self):
         super(PostgreSQLDriver, self)._setUp()
@@ -52,19 +70,156 @@ class PostgreSQLDriver(drivers.Driver):
         self.putenv("PGDATA", self.tempdir, True)
         self.putenv("PGDATABASE", "postgres", True)
         _, pgbindir = self._exec(["pg_config", "--bindir"], stdout=True)
-        pgctl = os.path.join(pgbindir.strip().decode(), "pg_ctl")
-        self._exec([pgctl, "-o", "'-Atrust'", "initdb"])
+        self.pgbindir = pgbindir.strip().decode()
+        pgctl = os.path.join(self.pgbindir, "pg_ctl")
+        initdb = [pgctl, "-o", "'-Atrust'", "initdb"]
+        self._bootstrap_cached(
+            "postgresql",
+            (initdb, self._executable_fingerprint(pgctl), getpass.getuser(),
+             [os.getenv(k) for k in ("LANG", "LC_ALL", "LC_CTYPE",
+                                     "LC_COLLATE")]),
+            self.tempdir, lambda: self._exec(initdb))
         if not self.sync:
             cfgfile = os.path.join(self.tempdir, 'postgresql.conf')
             with open(cfgfile, 'a') as cfg:
                 for key in ('fsync', 'synchronous_commit', 'full_page_writes'):
                     cfg.write('{} = off\n'.format(key))
 
-        self._exec([pgctl, "-w", "-o",
-                    "-k %s -p %d -h \"%s\""
-                    % (self.tempdir, self.port, self.host),
-                    "start"], allow_debug=False)
-        self.addCleanup(self._exec, [pgctl, "-w", "stop"])
-        self.url = "postgresql://localhost/postgres?host=%s&port=%d" % (
-            self.tempdir, self.port)
+        # pg_ctl does not wait for the server, whose errors are only in the
+        # log once pg_ctl returned
+        logfile = os.path.join(self.tempdir, "postgresql.log")
+        c, _ = self._exec([pgctl, "-W", "-l", logfile, "-o",
+                           "-k %s -p %d -h \"%s\""
+                           % (self.tempdir, self.port, self.host),
+                           "start"], allow_debug=False)
+        self.addCleanup(self._exec, [pgctl, "-w", "stop"],
+                        ignore_failure=True)
+        probe = probes.PostgreSQLProbe(
+            self.port,
+            path=os.path.join(self.tempdir, ".s.PGSQL.%d" % self.port),
+            user=getpass.getuser())
+
+        def _is_ready():
+            if probe():
+                return True
+            errors = self._get_start_errors(logfile)
+            if errors:
+                raise RuntimeError("PostgreSQL failed to start: %s"
+                                   % " ".join(errors))
+            return False
+
+        try:
+            self._wait_until_ready(c, _is_ready, "being ready for %s" % probe)
+        except RuntimeError as e:
+            raise RuntimeError("%s\nLog: %s" % (e, self._read_log(logfile)))
+        self.url = self.get_url()
         self.putenv("URL", self.url)
+
+    @staticmethod
+    def _read_log(logfile):
+        try:
+            with open(logfile, errors="replace") as f:
+                return f.read()
+        except FileNotFoundError:
+            return ""
+
+    def _get_start_errors(self, logfile):
+        """Return the fatal errors of the server log."""
+        return [line for line in self._read_log(logfile).splitlines()
+                if re.search(r"\b(FATAL|PANIC):", line)
+                and not _STARTING_ERROR_RE.search(line)]
+
+    def get_url(self, database="postgres"):
+        return "postgresql://localhost/%s?host=%s&port=%d" % (
+            database, self.tempdir, self.port)
+
+    @staticmethod
+    def _quote(name):
+        if not re.match(r"^[a-z_][a-z0-9_]*$", name):
+            raise ValueError("Invalid database name `%s'" % name)
+        return '"%s"' % name
+
+    def psql(self, sql=None, database="postgres", sql_file=None):
+        """Run SQL statements or a SQL file with psql, return its output.
+
+        The rows are printed unaligned, without headers.
+        """
+        # Not using _exec as this runs for every test: there is no need to
+        # track these short-lived processes until cleanup
+        command = [os.path.join(self.pgbindir, "psql"), "-X", "-q", "-A", "-t",
+                   "-v", "ON_ERROR_STOP=1", "-h", self.tempdir,
+                   "-p", str(self.port), "-d", database]
+        if sql is not None:
+            command.extend(["-c", sql])
+        if sql_file is not None:
+            command.extend(["-f", sql_file])
+        LOG.debug("executing: %s", command)
+        p = subprocess.run(command, stdin=subprocess.DEVNULL,
+                           stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        if p.returncode != 0:
+            raise RuntimeError("psql failed with status %d: %s"
+                               % (p.returncode, p.stdout.decode()))
+        return p.stdout
+
+    def create_template(self, name="pifpaf_template", sql=None,
+                        sql_file=None):
+        """Create a template database to clone with `create_database`.
+
+        `sql` and `sql_file` are run in the new database to create the
+        schema and seed it.
+        """
+        self.psql("CREATE DATABASE %s" % self._quote(name))
+        if sql is not None or sql_file is not None:
+            self.psql(sql, database=name, sql_file=sql_file)
+        self.psql("ALTER DATABASE %s IS_TEMPLATE true" % self._quote(name))
+        return name
+
+    def create_database(self, template="pifpaf_template", name=None):
+        """Create a new database, as a copy of `template`.
+
+        Return the name of the database.
+        """
+        if name is None:
+            name = "%s_%s" % (template, uuid.uuid4().hex[:12])
+        self.psql("CREATE DATABASE %s TEMPLATE %s"
+                  % (self._quote(name), self._quote(template)))
+        return name
+
+    def _drop_database(self, name):
+        try:
+            self.psql("DROP DATABASE IF EXISTS %s" % self._quote(name))
+        except RuntimeError as e:
+            LOG.warning("Unable to drop database %s: %s", name, e)
+
+    def drop_database(self, name, wait=False):
+        """Drop a database, in the background unless `wait` is True."""
+        if wait:
+            self._drop_database(name)
+            return
+        with self._drop_lock:
+            if self._drop_executor is None:
+                self._drop_executor = concurrent.futures.ThreadPoolExecutor(
+                    max_workers=1)
+                # Registered after the server stop, so it runs before
+                self.addCleanup(self._drop_executor.shutdown, wait=True)
+        self._drop_executor.submit(self._drop_database, name)
+
+
+class PostgreSQLDatabase(fixtures.Fixture):
+    """A database copied from a template of a `PostgreSQLDriver`.
+
+    Creating a database from a template is much faster than starting a new
+    server, which allows to give each test its own database. The database is
+    dropped in the background on cleanup.
+    """
+
+    def __init__(self, driver, template="pifpaf_template"):
+        """Create a new database from a template."""
+        super(PostgreSQLDatabase, self).__init__()
+        self.driver = driver
+        self.template = template
+
+    def _setUp(self):
+        self.name = self.driver.create_database(self.template)
+        self.addCleanup(self.driver.drop_database, self.name)
+        self.url = self.driver.get_url(self.name)
@@ -11,7 +11,6 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-import itertools
 import os
 import signal
 
@@ -24,6 +23,7 @@ class RabbitMQDriver(drivers.Driver):
     DEFAULT_NODENAME = "pifpaf"
     DEFAULT_USERNAME = "pifpaf"
     DEFAULT_PASSWORD = "secret"
+    STORAGE_SIZE = 128 * 1024 * 1024
 
     def __init__(self, port=DEFAULT_PORT, nodename=DEFAULT_NODENAME,
                  username=DEFAULT_USERNAME, password=DEFAULT_PASSWORD,
@@ -41,7 +41,6 @@ class RabbitMQDriver(drivers.Driver):
                       "/usr/local/sbin"]
         self._process = {}
         self._ports = {}
-        self._next_port = itertools.count(self.port)
 
     @classmethod
     def get_options(cls):
@@ -66,7 +65,13 @@ class RabbitMQDriver(drivers.Driver):
 
     def get_port(self, nodename):
         if nodename not in self._ports:
-            self._ports[nodename] = next(self._next_port)
+            if not self._ports:
+                port = self.port
+            elif "port" in self._allocated_ports:
+                port = self._allocate_port()
+            else:
+                port = self.port + len(self._ports)
+            self._ports[nodename] = port
         return self._ports[nodename]
 
     def start_node(self, nodename):
@@ -121,6 +126,13 @@ class RabbitMQDriver(drivers.Driver):
 
     def _setUp(self):
         super(RabbitMQDriver, self)._setUp()
+        self._process = {}
+        self._ports = {}
+        nodename = self.nodename
+        if ("port" in self._allocated_ports and
+           nodename == self.DEFAULT_NODENAME):
+            # Allocated ports are unique, so are node names using them
+            nodename = "%s-%d" % (nodename, self.port)
         self.env = {
             "RABBITMQ_ENABLED_PLUGINS_FILE": os.path.join(self.tempdir,
                                                           "notexists"),
@@ -130,9 +142,9 @@ class RabbitMQDriver(drivers.Driver):
         }
 
         if self.cluster:
-            n1 = self.nodename + "-1@localhost"
-            n2 = self.nodename + "-2@localhost"
-            n3 = self.nodename + "-3@localhost"
+            n1 = nodename + "-1@localhost"
+            n2 = nodename + "-2@localhost"
+            n3 = nodename + "-3@localhost"
             # Start master
             self.start_node(n1)
             self.start_node(n2)
@@ -140,7 +152,7 @@ class RabbitMQDriver(drivers.Driver):
             self.join_cluster(n2, n1)
             self.join_cluster(n3, n1)
         else:
-            n1 = self.nodename + "@localhost"
+            n1 = nodename + "@localhost"
             self.start_node(n1)
 
         self.rabbitmqctl(n1, ["add_user", self.username, self.password])
@@ -161,8 +173,8 @@ class RabbitMQDriver(drivers.Driver):
                             'username': self.username,
                             'password': self.password,
                             'port1': self.port,
-                            'port2': self.port + 1,
-                            'port3': self.port + 2})
+                            'port2': self.get_port(n2),
+                            'port3': self.get_port(n3)})
         else:
             self.putenv("RABBITMQ_NODENAME", n1)
             self.putenv("URL", "rabbit://%s:%s@localhost:%d//" % (
@@ -14,6 +14,7 @@
 import os
 
 from pifpaf import drivers
+from pifpaf import probes
 
 
 class ValkeyDriver(drivers.Driver):
@@ -61,7 +62,8 @@ port %d
         c, _ = self._exec(
             ["valkey-server", "-"],
             stdin=(valkey_conf).encode('ascii'),
-            wait_for_line="eady to accept connections")
+            wait_for_probe=probes.RedisProbe(self.port,
+                                             password=self.password))
 
         if self.sentinel:
             cfg = os.path.join(self.tempdir, "valkey-sentinel.conf")
@@ -80,8 +82,6 @@ sentinel monitor pifpaf 127.0.0.1 %d 1
                 ["valkey-sentinel", cfg],
                 wait_for_line=r"[#\*] Sentinel (runid|ID) is")
 
-            self.addCleanup(self._kill, c)
-
             self.putenv("VALKEY_SENTINEL_PORT",
                         str(self.sentinel_port))
 
@@ -14,6 +14,7 @@
 import uuid
 
 from pifpaf import drivers
+from pifpaf import probes
 
 
 class VaultDriver(drivers.Driver):
@@ -40,12 +41,15 @@ class VaultDriver(drivers.Driver):
 
     def _setUp(self):
         super(VaultDriver, self)._setUp()
+        host, _, port = self.listen_address.rpartition(":")
         c, _ = self._exec(["vault",
                            "server",
                            "-dev",
                            "-dev-root-token-id=" + self.root_token_id,
                            "-dev-listen-address=" + self.listen_address],
-                          wait_for_line="Vault server started!")
+                          wait_for_probe=probes.HTTPProbe(
+                              int(port), host, "/v1/sys/health",
+                              lambda status, body: status == 200))
 
         self.putenv("ROOT_TOKEN", self.root_token_id)
         self.putenv("VAULT_ADDR", "http://%s" % self.listen_address)
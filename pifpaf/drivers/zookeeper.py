@@ -14,6 +14,7 @@
 import os
 
 from pifpaf import drivers
+from pifpaf import probes
 
 
 class ZooKeeperDriver(drivers.Driver):
@@ -23,6 +24,7 @@ class ZooKeeperDriver(drivers.Driver):
     PATH = ["/usr/share/zookeeper/bin",
             "/usr/local/opt/zookeeper/libexec/bin",
             "/opt/zookeeper-bin/bin"]
+    STORAGE_SIZE = 128 * 1024 * 1024
 
     def __init__(self, port=DEFAULT_PORT, **kwargs):
         """Create a new ZooKeeper server."""
@@ -56,7 +58,7 @@ clientPort=%s
 
         c, _ = self._exec(
             ["zkServer.sh", "start", cfgfile],
-            wait_for_port=self.port,
+            wait_for_probe=probes.ZooKeeperProbe(self.port),
             path=self.PATH)
 
         self.addCleanup(self._exec,
@@ -0,0 +1,172 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import abc
+import contextlib
+import http.client
+import socket
+import struct
+
+
+class Probe(abc.ABC):
+    """Check if a service is ready.
+
+    A probe is a callable returning True once the service it checks is
+    usable. Drivers pass them to `Driver._exec` as `wait_for_probe`.
+    """
+
+    # Number of seconds to wait for a single check
+    TIMEOUT = 1
+
+    def __call__(self):
+        try:
+            return self.check()
+        except (OSError, http.client.HTTPException):
+            return False
+
+    @abc.abstractmethod
+    def check(self):
+        """Return True if the service is ready."""
+
+
+class TCPProbe(Probe):
+    """Send `request` to a TCP or Unix socket and expect `expected` back."""
+
+    def __init__(self, port=None, host="localhost", path=None,
+                 request=b"", expected=b""):
+        """Create a new TCP probe."""
+        self.port = port
+        self.host = host
+        self.path = path
+        self.request = request
+        self.expected = expected
+
+    def __str__(self):
+        """Describe the probe."""
+        if self.path:
+            return "%s(%s)" % (self.__class__.__name__, self.path)
+        return "%s(%s:%d)" % (self.__class__.__name__, self.host, self.port)
+
+    def _connect(self):
+        if self.path:
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.settimeout(self.TIMEOUT)
+            try:
+                sock.connect(self.path)
+            except OSError:
+                sock.close()
+                raise
+            return sock
+        return socket.create_connection((self.host, self.port),
+                                        timeout=self.TIMEOUT)
+
+    def check(self):
+        with contextlib.closing(self._connect()) as sock:
+            if self.request:
+                sock.sendall(self.request)
+            data = b""
+            while len(data) < len(self.expected):
+                chunk = sock.recv(1024)
+                if not chunk:
+                    break
+                data += chunk
+            return self.validate(data)
+
+    def validate(self, data):
+        return data.startswith(self.expected)
+
+
+class RedisProbe(TCPProbe):
+    """Send a PING command to Redis (or Valkey) and wait for PONG."""
+
+    def __init__(self, port, host="localhost", password=None):
+        """Create a new Redis probe."""
+        request = b"PING\r\n"
+        expected = b"+PONG"
+        if password:
+            request = b"AUTH " + password.encode() + b"\r\n" + request
+            expected = b"+OK\r\n" + expected
+        super(RedisProbe, self).__init__(port, host,
+                                         request=request, expected=expected)
+
+
+class MemcachedProbe(TCPProbe):
+    """Send the memcached `version` command."""
+
+    def __init__(self, port, host="localhost"):
+        """Create a new memcached probe."""
+        super(MemcachedProbe, self).__init__(port, host,
+                                             request=b"version\r\n",
+                                             expected=b"VERSION ")
+
+
+class ZooKeeperProbe(TCPProbe):
+    """Send the ZooKeeper `ruok` four-letter command."""
+
+    def __init__(self, port, host="localhost"):
+        """Create a new ZooKeeper probe."""
+        super(ZooKeeperProbe, self).__init__(port, host, request=b"ruok",
+                                             expected=b"imok")
+
+
+class PostgreSQLProbe(TCPProbe):
+    """Send a PostgreSQL startup packet and wait for the server to answer.
+
+    The server is ready when it asks for authentication (or accepts the
+    connection right away); while it starts it answers with an error.
+    """
+
+    def __init__(self, port, host="localhost", path=None,
+                 user="postgres", database="postgres"):
+        """Create a new PostgreSQL probe."""
+        params = b"user\0%s\0database\0%s\0\0" % (user.encode(),
+                                                  database.encode())
+        # Protocol version 3.0
+        request = struct.pack("!II", 8 + len(params), 196608) + params
+        super(PostgreSQLProbe, self).__init__(port, host, path,
+                                              request=request, expected=b"R")
+
+
+class HTTPProbe(Probe):
+    """Send a GET request and wait for an expected answer.
+
+    By default, any status below 500 means the service is ready. `validate`
+    can be given to check the status and the body of the response.
+    """
+
+    def __init__(self, port, host="localhost", path="/", validate=None):
+        """Create a new HTTP probe."""
+        self.port = port
+        self.host = host
+        self.path = path
+        if validate is not None:
+            self.validate = validate
+
+    def __str__(self):
+        """Describe the probe."""
+        return "HTTPProbe(http://%s:%d%s)" % (self.host, self.port,
+                                              self.path)
+
+    @staticmethod
+    def validate(status, body):
+        return status < 500
+
+    def check(self):
+        conn = http.client.HTTPConnection(self.host, self.port,
+                                          timeout=self.TIMEOUT)
+        try:
+            conn.request("GET", self.path)
+            response = conn.getresponse()
+            return self.validate(response.status, response.read())
+        finally:
+            conn.close()
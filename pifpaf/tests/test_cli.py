@@ -11,15 +11,21 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import json
 import os
 import shutil
 import signal
 import subprocess
+import sys
+import textwrap
 
 import fixtures
 
 import testtools
 
+from pifpaf import __main__ as main
+from pifpaf.drivers import memcached
+
 
 class TestCli(testtools.TestCase):
 
@@ -147,6 +153,78 @@ class TestCli(testtools.TestCase):
             b"\"memcached://localhost:11217;memcached://localhost:11218\";",
             env[b"export PIFPAF_URLS"])
 
+    @testtools.skipUnless(shutil.which("memcached"),
+                          "memcached not found")
+    def test_up(self):
+        topology = os.path.join(self.useFixture(fixtures.TempDir()).path,
+                                "topology.toml")
+        with open(topology, "w") as f:
+            f.write(textwrap.dedent("""
+                [cache1]
+                driver = "memcached"
+                options = {port = 11220}
+
+                [cache2]
+                driver = "memcached"
+                depends_on = ["cache1"]
+                options = {port = 11221}
+            """))
+        c = subprocess.Popen(["pifpaf", "up", topology],
+                             stdout=subprocess.PIPE)
+        (stdout, stderr) = c.communicate()
+        self.assertEqual(0, c.wait())
+        env = self._read_stdout_and_kill(stdout)
+
+        self.assertEqual(b"\"memcached://localhost:11220\";",
+                         env[b"export PIFPAF_CACHE1_URL"])
+        self.assertEqual(b"\"memcached://localhost:11221\";",
+                         env[b"export PIFPAF_CACHE2_URL"])
+        self.assertEqual(
+            b"\"memcached://localhost:11220;memcached://localhost:11221\";",
+            env[b"export PIFPAF_URLS"])
+
+    def test_up_dependency_cycle(self):
+        topology = os.path.join(self.useFixture(fixtures.TempDir()).path,
+                                "topology.toml")
+        with open(topology, "w") as f:
+            f.write(textwrap.dedent("""
+                [a]
+                driver = "memcached"
+                depends_on = ["b"]
+
+                [b]
+                driver = "memcached"
+                depends_on = ["a"]
+            """))
+        c = subprocess.Popen(["pifpaf", "up", topology],
+                             stderr=subprocess.PIPE,
+                             stdout=subprocess.PIPE)
+        (stdout, stderr) = c.communicate()
+        self.assertEqual(1, c.wait())
+        self.assertIn(b"Dependency cycle between nodes: a, b", stderr)
+
+    def test_list_does_not_set_up_logging(self):
+        c = subprocess.Popen(
+            [sys.executable, "-c",
+             "import sys; from pifpaf import __main__; "
+             "__main__.main.main(['list'], standalone_mode=False); "
+             "print('daiquiri' in sys.modules)"],
+            stdout=subprocess.PIPE)
+        (stdout, stderr) = c.communicate()
+        self.assertEqual(0, c.wait())
+        self.assertEqual(b"False", stdout.splitlines()[-1])
+
+    def test_unknown_daemon(self):
+        for command in (["bench-drivers", "nosuch"],
+                        ["agent", "--pool", "nosuch"]):
+            c = subprocess.Popen(["pifpaf"] + command,
+                                 stderr=subprocess.PIPE,
+                                 stdout=subprocess.PIPE)
+            (stdout, stderr) = c.communicate()
+            self.assertEqual(2, c.wait())
+            self.assertIn(b"Unknown daemon `nosuch'", stderr)
+            self.assertNotIn(b"Traceback", stderr)
+
     def test_list_command(self):
         c = subprocess.Popen(["pifpaf", "list"],
                              bufsize=0,
@@ -155,6 +233,29 @@ class TestCli(testtools.TestCase):
         self.assertEqual(0, c.wait())
         self.assertIn(b'memcached', stdout)
 
+    def test_daemons_index(self):
+        cache_home = self.useFixture(fixtures.TempDir()).path
+        self.useFixture(fixtures.EnvironmentVariable("XDG_CACHE_HOME",
+                                                     cache_home))
+        self.useFixture(fixtures.MonkeyPatch("pifpaf.__main__._DAEMONS", None))
+        self.assertIn("memcached", main._daemons_names())
+        path = os.path.join(cache_home, "pifpaf", "daemons.json")
+        with open(path) as f:
+            index = json.load(f)
+        self.assertIn(
+            ["memcached", "pifpaf.drivers.memcached:MemcachedDriver"],
+            index["daemons"])
+
+        # An outdated index is reloaded
+        index["daemons"] = [["memcached", "pifpaf.drivers.nope:Nope"]]
+        with open(path, "w") as f:
+            json.dump(index, f)
+        main._DAEMONS = None
+        self.assertEqual(["memcached"], main._daemons_names())
+        self.assertIs(memcached.MemcachedDriver,
+                      main._get_daemon("memcached"))
+        self.assertIn("redis", main._daemons_names())
+
     def test_non_existing_command(self):
         # Keep PATH to just the one set by tox to run pifpaf
         self.useFixture(fixtures.EnvironmentVariable(
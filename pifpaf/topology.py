@@ -0,0 +1,196 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import concurrent.futures
+import logging
+import os
+import string
+import sys
+
+import fixtures
+
+from pifpaf import drivers
+
+try:
+    import tomllib
+except ImportError:
+    # Python < 3.11
+    import tomli as tomllib
+
+try:
+    import yaml
+except ImportError:
+    yaml = None
+
+
+LOG = logging.getLogger(__name__)
+
+
+class Node(object):
+    def __init__(self, name, driver=None, env_prefix=None, depends_on=(),
+                 options=None):
+        """Create a new topology node."""
+        self.name = name
+        self.driver = driver or name
+        self.env_prefix = env_prefix
+        self.depends_on = list(depends_on)
+        self.options = options or {}
+
+
+def load(path):
+    """Load the nodes of a topology from a TOML or YAML file.
+
+    Each top-level table describes a node, with the following optional keys:
+    `driver` (defaults to the table name), `env_prefix`, `depends_on` (a list
+    of node names) and `options` (the driver options).
+    """
+    if path.endswith((".yaml", ".yml")):
+        if yaml is None:
+            raise RuntimeError("PyYAML is required to load %s" % path)
+        with open(path) as f:
+            content = yaml.safe_load(f) or {}
+    else:
+        with open(path, "rb") as f:
+            content = tomllib.load(f)
+
+    nodes = []
+    for name, spec in content.items():
+        spec = spec or {}
+        unknown = set(spec) - set(("driver", "env_prefix", "depends_on",
+                                   "options"))
+        if unknown:
+            raise RuntimeError("Unknown keys for node `%s': %s"
+                               % (name, ", ".join(sorted(unknown))))
+        nodes.append(Node(name, **spec))
+    return nodes
+
+
+class Topology(fixtures.Fixture):
+    """Start a set of drivers, following their dependencies.
+
+    Nodes whose dependencies are all started are started in parallel, with at
+    most `jobs` of them starting at the same time. String options of a node
+    can reference the environment variables exported by the nodes it depends
+    on, e.g. `${PIFPAF_POSTGRESQL_URL}`.
+
+    With `dynamic_ports`, the ports that are not given in the options of a
+    node are allocated.
+    """
+
+    def __init__(self, nodes, get_driver, env_prefix="PIFPAF",
+                 global_urls_variable="PIFPAF_URLS", jobs=None, debug=False,
+                 dynamic_ports=False):
+        """Create a new topology."""
+        super(Topology, self).__init__()
+        self.nodes = nodes
+        self.get_driver = get_driver
+        self.env_prefix = env_prefix
+        self.global_urls_variable = global_urls_variable
+        self.jobs = jobs
+        self.debug = debug
+        self.dynamic_ports = dynamic_ports
+        self.drivers = {}
+        self.env = {}
+
+    def _check_dependencies(self):
+        names = set(node.name for node in self.nodes)
+        for node in self.nodes:
+            for dep in node.depends_on:
+                if dep not in names:
+                    raise RuntimeError("Node `%s' depends on unknown node "
+                                       "`%s'" % (node.name, dep))
+        resolved = set()
+        remaining = list(self.nodes)
+        while remaining:
+            ready = [node for node in remaining
+                     if set(node.depends_on) <= resolved]
+            if not ready:
+                raise RuntimeError(
+                    "Dependency cycle between nodes: %s"
+                    % ", ".join(node.name for node in remaining))
+            for node in ready:
+                resolved.add(node.name)
+                remaining.remove(node)
+
+    def _start(self, node, deps_env):
+        environ = dict(os.environ)
+        environ.update(deps_env)
+        options = {}
+        for key, value in node.options.items():
+            if isinstance(value, str):
+                value = string.Template(value).safe_substitute(environ)
+            options[key] = value
+        env_prefix = (node.env_prefix or
+                      "%s_%s" % (self.env_prefix, node.name.upper()))
+        plugin = self.get_driver(node.driver)
+        if self.dynamic_ports:
+            for name in plugin.get_port_option_names():
+                options.setdefault(name, 0)
+        LOG.info("starting %s", node.name)
+        driver = plugin(env_prefix=env_prefix, debug=self.debug, **options)
+        # The nodes are set up concurrently, their variables are exported
+        # once they are all started
+        with drivers.private_environ(deps_env):
+            driver.setUp()
+        LOG.info("%s is ready", node.name)
+        return driver
+
+    def _setUp(self):
+        self._check_dependencies()
+        pending = list(self.nodes)
+        running = {}
+        error = None
+        with concurrent.futures.ThreadPoolExecutor(
+                max_workers=self.jobs) as executor:
+            while pending or running:
+                if error is None:
+                    for node in list(pending):
+                        if all(dep in self.drivers
+                               for dep in node.depends_on):
+                            pending.remove(node)
+                            deps_env = {}
+                            for dep in node.depends_on:
+                                deps_env.update(self.drivers[dep].env)
+                            running[executor.submit(
+                                self._start, node, deps_env)] = node
+                if not running:
+                    break
+                done, _ = concurrent.futures.wait(
+                    running, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    node = running.pop(future)
+                    try:
+                        driver = future.result()
+                    except Exception:  # noqa: B902
+                        if error is None:
+                            error = sys.exc_info()
+                    else:
+                        self.drivers[node.name] = driver
+                        self.addCleanup(driver.cleanUp)
+
+        if error is not None:
+            raise error[1].with_traceback(error[2])
+
+        urls = []
+        for node in self.nodes:
+            driver = self.drivers[node.name]
+            self.env.update(driver.env)
+            url = driver.env.get(driver.env_prefix + "_URL")
+            if url:
+                urls.append(url)
+        current_urls = os.getenv(self.global_urls_variable)
+        if current_urls:
+            urls.insert(0, current_urls)
+        self.env[self.global_urls_variable] = ";".join(urls)
+        for key, value in self.env.items():
+            self.useFixture(fixtures.EnvironmentVariable(key, value))
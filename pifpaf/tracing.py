@@ -0,0 +1,129 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Record how long the steps of the drivers take.
+
+Spans are only recorded once `enable` has been called, so that drivers do
+not pay for it otherwise.
+"""
+
+import atexit
+import contextlib
+import json
+import os
+import threading
+import time
+
+FORMATS = ("json", "chrome")
+
+_lock = threading.Lock()
+_spans = None
+
+
+def enable():
+    """Start recording spans."""
+    global _spans
+    with _lock:
+        if _spans is None:
+            _spans = []
+
+
+def disable():
+    """Stop recording spans and return the ones recorded."""
+    global _spans
+    with _lock:
+        spans, _spans = _spans, None
+    return spans or []
+
+
+def is_enabled():
+    return _spans is not None
+
+
+def get_spans():
+    with _lock:
+        return list(_spans or [])
+
+
+@contextlib.contextmanager
+def span(name, phase, **args):
+    """Record the time spent in the block as a span.
+
+    `phase` is the kind of step (e.g. `setup`, `exec`, `wait_for_line`),
+    `args` are extra details such as the command or the pid. They can be
+    completed from the block through the yielded dict.
+    """
+    if _spans is None:
+        yield args
+        return
+    start = time.time()
+    begin = time.perf_counter()
+    try:
+        yield args
+    finally:
+        record = {
+            "name": name,
+            "phase": phase,
+            "start": start,
+            "duration": time.perf_counter() - begin,
+            "pid": os.getpid(),
+            "tid": threading.get_native_id(),
+            "args": args,
+        }
+        with _lock:
+            if _spans is not None:
+                _spans.append(record)
+
+
+def to_chrome(spans):
+    """Convert spans to the Chrome trace event format.
+
+    The result can be loaded in chrome://tracing or https://ui.perfetto.dev.
+    """
+    return {
+        "traceEvents": [{
+            "name": s["name"],
+            "cat": s["phase"],
+            "ph": "X",
+            "ts": s["start"] * 1000000,
+            "dur": s["duration"] * 1000000,
+            "pid": s["pid"],
+            "tid": s["tid"],
+            "args": dict((k, str(v)) for k, v in s["args"].items()),
+        } for s in spans],
+        "displayTimeUnit": "ms",
+    }
+
+
+def dump(path, fmt="json", spans=None):
+    """Write the spans to `path` as `json` or `chrome` trace events."""
+    if fmt not in FORMATS:
+        raise ValueError("Unknown trace format `%s'" % fmt)
+    if spans is None:
+        spans = get_spans()
+    if fmt == "chrome":
+        content = to_chrome(spans)
+    else:
+        content = {"spans": spans}
+    with open(path, "w") as f:
+        json.dump(content, f, indent=2, default=str)
+
+
+def dump_at_exit(path, fmt="json"):
+    """Record spans and write them to `path` when the process exits.
+
+    A process forked afterwards, e.g. to keep the daemons running, rewrites
+    the file when it exits, with the cleanup spans included.
+    """
+    enable()
+    atexit.register(dump, os.path.abspath(path), fmt)
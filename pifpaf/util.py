@@ -11,65 +11,226 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import contextlib
 import errno
 import logging
 import os
+import shutil
+import socket
+import subprocess
+import time
+
+import fixtures
 
 import psutil
 
 LOG = logging.getLogger(__name__)
 
 
-def _get_procs_of_pgid(wanted_pgid):
-    procs = []
-    for p in psutil.process_iter():
+def format_error(e):
+    """Return the message of the error that made a fixture setUp fail."""
+    if isinstance(e, fixtures.MultipleExceptions):
+        for etype, value, tb in e.args:
+            if etype is not fixtures.SetupError:
+                # The error of a fixture used by the fixture
+                return format_error(value)
+    return str(e)
+
+
+def clone_tree(src, dst):
+    """Copy the content of the directory `src` into the directory `dst`.
+
+    Copy-on-write clones are used when the filesystem supports them.
+    """
+    try:
+        subprocess.run(["cp", "-a", "--reflink=auto",
+                        os.path.join(src, "."), dst],
+                       stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                       check=True)
+    except (OSError, subprocess.CalledProcessError):
+        # Not GNU cp, use a regular copy
+        shutil.copytree(src, dst, symlinks=True, dirs_exist_ok=True)
+
+
+def wait_for(check, timeout, interval=0.01, max_interval=0.25):
+    """Call `check` until it returns True, with an increasing delay.
+
+    Return False if `check` did not return True within `timeout` seconds.
+    """
+    deadline = time.monotonic() + timeout
+    while not check():
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return False
+        time.sleep(min(interval, remaining))
+        interval = min(interval * 2, max_interval)
+    return True
+
+
+def _get_listening_sockets_from_proc(port):
+    """Return the inodes of the sockets listening on the TCP `port`."""
+    inodes = set()
+    for filename in ("/proc/net/tcp", "/proc/net/tcp6"):
         try:
-            pgid = os.getpgid(p.pid)
-        except OSError as e:
-            # ESRCH is returned if process just died in the meantime
-            if e.errno != errno.ESRCH:
-                raise
+            with open(filename) as f:
+                next(f)
+                for line in f:
+                    fields = line.split()
+                    # 0A is TCP_LISTEN
+                    if (fields[3] == "0A" and
+                            int(fields[1].rsplit(":", 1)[1], 16) == port):
+                        inodes.add(fields[9])
+        except FileNotFoundError:
+            pass
+    return inodes
+
+
+def _get_socket_inodes(pid):
+    """Return the inodes of the sockets opened by the process `pid`."""
+    inodes = set()
+    fddir = "/proc/%d/fd" % pid
+    for fd in os.listdir(fddir):
+        try:
+            target = os.readlink(os.path.join(fddir, fd))
+        except FileNotFoundError:
+            # Closed in the meantime
             continue
-        if pgid == wanted_pgid:
-            procs.append(p)
+        if target.startswith("socket:["):
+            inodes.add(target[8:-1])
+    return inodes
+
+
+def is_port_listening(port, procs):
+    """Check if one of the processes `procs` listens on the TCP `port`.
+
+    On Linux, the sockets in LISTEN state are read from /proc/net/tcp{,6}
+    and looked up in the file descriptors of `procs`. Otherwise, psutil
+    lists the sockets of `procs`. If that is not allowed, a connection to
+    the port is attempted.
+    """
+    if os.path.exists("/proc/net/tcp"):
+        inodes = _get_listening_sockets_from_proc(port)
+        if not inodes:
+            return False
+        for p in procs:
+            try:
+                if inodes & _get_socket_inodes(p.pid):
+                    return True
+            except FileNotFoundError:
+                # The process exited
+                pass
+            except PermissionError:
+                # Not our process, assume it is the one listening
+                return True
+        return False
+    try:
+        for p in procs:
+            try:
+                conns = p.net_connections(kind="inet")
+            except AttributeError:
+                # psutil < 6
+                conns = p.connections(kind="inet")
+            for conn in conns:
+                if (conn.status == psutil.CONN_LISTEN and
+                        conn.laddr.port == port):
+                    return True
+    except psutil.NoSuchProcess:
+        pass
+    except psutil.AccessDenied:
+        with contextlib.closing(
+                socket.socket(socket.AF_INET, socket.SOCK_STREAM)) as sock:
+            return sock.connect_ex(('127.0.0.1', port)) == 0
+    return False
+
+
+def _iter_pgids():
+    """Yield (pid, pgid) for all processes of the host."""
+    if os.path.isdir("/proc/self"):
+        # Reading /proc once is much cheaper than creating a psutil.Process
+        # and calling getpgid() for each process of the host
+        for entry in os.scandir("/proc"):
+            if not entry.name.isdigit():
+                continue
+            try:
+                with open(os.path.join(entry.path, "stat"), "rb") as f:
+                    stat = f.read()
+            except OSError:
+                # Process just died in the meantime
+                continue
+            # The command name is between parenthesis and can contain
+            # spaces, the fields after are: state, ppid and pgrp
+            fields = stat[stat.rindex(b")") + 2:].split()
+            yield int(entry.name), int(fields[2])
+    else:
+        for pid in psutil.pids():
+            try:
+                yield pid, os.getpgid(pid)
+            except OSError as e:
+                # ESRCH is returned if process just died in the meantime
+                if e.errno != errno.ESRCH:
+                    raise
+
+
+def _get_procs_of_pgids(wanted_pgids):
+    procs = []
+    for pid, pgid in _iter_pgids():
+        if pgid in wanted_pgids:
+            try:
+                procs.append(psutil.Process(pid))
+            except psutil.NoSuchProcess:
+                pass
     return procs
 
 
-def process_cleaner(parent):
-    do_sigkill = False
+def _describe(p):
+    try:
+        return "%s (%s)" % (" ".join(p.cmdline()), p.pid)
+    except psutil.Error:
+        return str(p.pid)
+
+
+def process_cleaner(*parents):
+    """Terminate processes and all the processes they started.
+
+    All the processes are signaled at once and waited for together, so
+    stopping several processes takes as long as the slowest of them.
+    """
     # NOTE(sileht): Add processes from process tree and process group
     # Relying on process tree only will not work in case of
     # parent dying prematuraly and double fork
     # Relying on process group only will not work in case of
     # subprocess calling again setsid()
-    procs = set(_get_procs_of_pgid(parent.pid))
-    try:
-        LOG.debug("Terminating %s (%s)",
-                  " ".join(parent.cmdline()), parent.pid)
-        procs |= set(parent.children(recursive=True))
-        procs.add(parent)
-        parent.terminate()
-    except psutil.NoSuchProcess:
-        LOG.warning("`%s` is already gone, sending SIGKILL to its process "
-                    "group", parent)
-        do_sigkill = True
-    else:
+    procs = set(_get_procs_of_pgids(set(parent.pid for parent in parents)))
+    terminated = []
+    do_sigkill = False
+    for parent in parents:
+        try:
+            LOG.debug("Terminating %s", _describe(parent))
+            procs |= set(parent.children(recursive=True))
+            procs.add(parent)
+            parent.terminate()
+        except psutil.NoSuchProcess:
+            LOG.warning("`%s` is already gone, sending SIGKILL to its "
+                        "process group", parent)
+            do_sigkill = True
+        else:
+            terminated.append(parent)
+
+    if terminated:
         # Waiting for all processes to stop
         for p in procs:
-            try:
-                LOG.debug("Waiting %s (%s)", " ".join(p.cmdline()), p.pid)
-            except psutil.NoSuchProcess:
-                pass
+            LOG.debug("Waiting %s", _describe(p))
         gone, alive = psutil.wait_procs(procs, timeout=10)
         if alive:
             do_sigkill = True
             LOG.warning("`%s` didn't terminate cleanly after 10 seconds, "
-                        "sending SIGKILL to its process group", parent)
+                        "sending SIGKILL to its process group",
+                        ", ".join(map(str, alive)))
 
     if do_sigkill and procs:
         for p in procs:
             try:
-                LOG.debug("Killing %s (%s)", " ".join(p.cmdline()), p.pid)
+                LOG.debug("Killing %s", _describe(p))
                 p.kill()
             except psutil.NoSuchProcess:
                 pass
@@ -78,4 +239,5 @@ def process_cleaner(parent):
             LOG.warning("`%s` survive SIGKILL", alive)
 
     # Be sure to get returncode
-    parent.wait()
+    for parent in parents:
+        parent.wait()